@@ -0,0 +1,123 @@
+"""
+Correlation between the results of emulation.queue_model.QueueSimulator and a reference simulation backend - CityFlow,
+or benchmarks.fake_engine - over the same candidates, and the time each takes per evaluation. The queue model is only
+useful for screening if it ranks candidates as the reference does, so rank (Spearman) correlation is what matters.
+
+Candidates on I_graph() are random phase timings. Spiral graphs have no intersections with traffic lights, so their
+candidates instead vary the spiral's size and the interval of its flows.
+
+Run from the repository root with:
+
+    python -m benchmarks.engine_correlation --reference cityflow --output benchmarks/results/correlation.json
+"""
+import argparse
+import json
+import os
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from scipy.stats import pearsonr, spearmanr
+
+from benchmarks.fake_engine import FakeEngine
+from emulation.engines import cityflow_engine
+from emulation.queue_model import QueueSimulator
+from emulation.simulator import Simulator
+from metrics.metrics import CompletedJourneysMetric, WaitTimeMetric
+from simulation_builder.flows import CustomEndpointFlowStrategy
+from simulation_builder.graph import I_graph, spiral_graph
+
+METRICS = [CompletedJourneysMetric, WaitTimeMetric]
+
+
+def i_graph_results(engine_factory: Callable, candidates: int, steps: int, seed: int
+                    ) -> Tuple[np.ndarray, np.ndarray, float, float]:
+    """
+    Evaluates random timings of I_graph() on the reference backend and the queue model, returning both sets of
+    results and the mean time per evaluation of each
+    """
+    g = I_graph()
+    reference = Simulator(g, METRICS, timing_period=60, steps=steps, engine_factory=engine_factory)
+    queue = QueueSimulator(g, METRICS, timing_period=60, steps=steps)
+    x = np.random.default_rng(seed).uniform(1, 30, size=(candidates, len(reference.intersections) * 3))
+
+    start = time.perf_counter()
+    expected = np.vstack([reference.evaluate(row) for row in x])
+    reference_time = (time.perf_counter() - start) / candidates
+
+    start = time.perf_counter()
+    actual = np.vstack([result.values for result in queue.simulate_batch(x)])
+    queue_time = (time.perf_counter() - start) / candidates
+
+    return expected, actual, reference_time, queue_time
+
+
+def spiral_results(engine_factory: Callable, sizes: List[int], intervals: List[float], steps: int
+                   ) -> Tuple[np.ndarray, np.ndarray, float, float]:
+    """As i_graph_results, for spirals of each size with flows of each interval"""
+    expected, actual = [], []
+    reference_time = queue_time = 0.0
+    for size in sizes:
+        g = spiral_graph(size)
+        for interval in intervals:
+            strategy = CustomEndpointFlowStrategy({endpoint: interval for endpoint in g.endpoints()})
+
+            start = time.perf_counter()
+            expected.append(Simulator(g, METRICS, strategy, steps=steps, engine_factory=engine_factory)
+                            .evaluate(np.zeros(0)))
+            reference_time += time.perf_counter() - start
+
+            # Each spiral is its own queue model, so its construction is timed too
+            start = time.perf_counter()
+            actual.append(QueueSimulator(g, METRICS, strategy, steps=steps).evaluate(np.zeros(0)))
+            queue_time += time.perf_counter() - start
+
+    candidates = len(sizes) * len(intervals)
+    return np.vstack(expected), np.vstack(actual), reference_time / candidates, queue_time / candidates
+
+
+def report(expected: np.ndarray, actual: np.ndarray, reference_time: float, queue_time: float) -> Dict:
+    """Correlations of each metric's results, and the time per evaluation of each backend"""
+    correlations = {}
+    for i, metric in enumerate(METRICS):
+        name = metric().name
+        correlations[name] = {"spearman": float(spearmanr(expected[:, i], actual[:, i]).correlation),
+                              "pearson": float(pearsonr(expected[:, i], actual[:, i])[0])}
+        print(f"  {name:25s} spearman={correlations[name]['spearman']:6.3f}  "
+              f"pearson={correlations[name]['pearson']:6.3f}")
+    print(f"  {'seconds per evaluation':25s} reference={reference_time:.4f}  queue={queue_time:.4f}  "
+          f"speed-up={reference_time / queue_time:.1f}x")
+
+    return {"candidates": len(expected), "correlation": correlations, "reference_seconds": reference_time,
+            "queue_seconds": queue_time}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reference", choices=["cityflow", "fake"], default="cityflow",
+                        help="Backend to compare the queue model against")
+    parser.add_argument("--candidates", type=int, default=50, help="Random timings to evaluate on I_graph()")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[3, 5, 8, 12], help="Sizes of spiral graphs")
+    parser.add_argument("--intervals", type=float, nargs="+", default=[1.0, 2.0, 4.0, 8.0],
+                        help="Flow intervals on each spiral graph")
+    parser.add_argument("--steps", type=int, default=1000, help="Steps of each simulation")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON file to write the report to")
+    args = parser.parse_args()
+
+    engine_factory = cityflow_engine if args.reference == "cityflow" else FakeEngine
+
+    print("I_graph():")
+    results = {"reference": args.reference,
+               "I_graph": report(*i_graph_results(engine_factory, args.candidates, args.steps, args.seed))}
+    print("Spiral graphs:")
+    results["spiral"] = report(*spiral_results(engine_factory, args.sizes, args.intervals, args.steps))
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Compares evaluating candidates with a new engine per evaluation against a single persistent engine, which is reset
+between evaluations and has its traffic light phases driven from Python.
+
+Run from the repository root with:
+
+    python -m benchmarks.engine_reuse --candidates 20
+"""
+import argparse
+import time
+
+import numpy as np
+
+from emulation.simulator import Simulator
+from metrics.metrics import CompletedJourneysMetric
+from simulation_builder.flows import FlowStrategy
+from simulation_builder.graph import I_graph
+
+
+def time_evaluations(sim: Simulator, candidates: np.ndarray):
+    start = time.perf_counter()
+    results = np.vstack([sim.evaluate(x) for x in candidates])
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--candidates", type=int, default=20)
+    parser.add_argument("--steps", type=int, nargs="+", default=[1, 100, 1000])
+    args = parser.parse_args()
+
+    np.random.seed(42)
+    g = I_graph()
+    num_params = len([v for v in g if len(g[v]) > 2]) * 3
+    candidates = np.random.uniform(0.1, 20, size=(args.candidates, num_params))
+
+    for steps in args.steps:
+        file_based = Simulator(g, CompletedJourneysMetric, FlowStrategy(), timing_period=60, steps=steps)
+        persistent = Simulator(g, CompletedJourneysMetric, FlowStrategy(), timing_period=60, steps=steps,
+                               persistent_engine=True)
+
+        file_time, file_results = time_evaluations(file_based, candidates)
+        persistent_time, persistent_results = time_evaluations(persistent, candidates)
+
+        # With very few steps, evaluation time is dominated by engine construction
+        print(f"steps={steps:5d}  file-based={file_time / len(candidates) * 1000:9.2f}ms/eval  "
+              f"persistent={persistent_time / len(candidates) * 1000:9.2f}ms/eval  "
+              f"saving={(file_time - persistent_time) / len(candidates) * 1000:9.2f}ms/eval  "
+              f"identical={np.array_equal(file_results, persistent_results)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Deterministic, pure Python stand-in for CityFlow's Engine, so that simulations can be benchmarked on machines without
+the compiled cityflow module.
+
+It reads the same config, roadnet and flow files as CityFlow, and implements the parts of the engine's interface used
+by the simulator and metrics. Its traffic model is deliberately simple: vehicles drive at their maximum speed, queue
+behind each other in the lane for their next turn, and cross an intersection (one vehicle per road link per step) when
+their road link is in the current traffic light phase. Results are not comparable with CityFlow's, but the amount of
+work per step grows with the number of vehicles and roads in the same way.
+"""
+import copy
+import json
+import math
+from collections import deque
+from typing import Dict, List
+
+from emulation.engines import Engine
+
+class FakeEngine(Engine):
+    def __init__(self, config_file: str, thread_num: int = 1):
+        """
+        Parameters
+        ----------
+        config_file:    CityFlow config file, giving the roadnet and flow files to simulate
+        thread_num:     Ignored - accepted for compatibility with CityFlow's Engine
+        """
+        with open(config_file, 'r') as f:
+            config = json.loads(f.read())
+
+        directory = config["dir"]
+        with open(directory + config["roadnetFile"], 'r') as f:
+            roadnet = json.loads(f.read())
+        with open(directory + config["flowFile"], 'r') as f:
+            self._flows = json.loads(f.read())
+
+        self._interval = config.get("interval", 1.0)
+        self._rl_traffic_light = config.get("rlTrafficLight", False)
+
+        # Length, number of lanes and end intersection of each road
+        self._roads = {}
+        for road in roadnet["roads"]:
+            start, end = road["points"][0], road["points"][-1]
+            self._roads[road["id"]] = (math.hypot(end["x"] - start["x"], end["y"] - start["y"]), len(road["lanes"]),
+                                       road["endIntersection"])
+        self._lanes = [f"{road}_{i}" for road, (_, num_lanes, _) in self._roads.items() for i in range(num_lanes)]
+
+        # Index of each road link, the lane it is entered from, and the road links available in each light phase
+        self._intersections = {}
+        for intersection in roadnet["intersections"]:
+            links = {(link["startRoad"], link["endRoad"]): (i, link["laneLinks"][0]["startLaneIndex"]
+                                                            if link["laneLinks"] else 0)
+                     for i, link in enumerate(intersection["roadLinks"])}
+            phases = [(phase["time"], frozenset(phase["availableRoadLinks"]))
+                      for phase in intersection["trafficLight"]["lightphases"]]
+            self._intersections[intersection["id"]] = (intersection["virtual"], links, phases)
+
+        self._replay = None
+        if config.get("saveReplay", False):
+            with open(directory + config["roadnetLogFile"], 'w') as f:
+                f.write(json.dumps({"static": roadnet}))
+            self._replay = open(directory + config["replayLogFile"], 'w')
+
+        self.reset()
+
+    def reset(self, seed: bool = False) -> None:
+        """Removes every vehicle and restarts the simulation. The engine is deterministic, so seed has no effect."""
+        self._time = 0.0
+        # Route, position along the route, distance along the current road, speed, length plus minimum gap, maximum
+        # speed and whether it has entered the roadnet, of each vehicle in order of spawning
+        self._vehicles: Dict[str, list] = {}
+        # Vehicles on each lane, front first
+        self._lane_vehicles: Dict[str, List[str]] = {lane: [] for lane in self._lanes}
+        # Vehicles waiting to enter the roadnet, queued by the lane they enter
+        self._waiting: Dict[str, deque] = {}
+        self._num_waiting = 0
+        self._spawned = [0] * len(self._flows)
+        # Current phase and the time remaining in it, for each intersection
+        self._lights = {intersection: [0, phases[0][0] if phases else 0.0]
+                        for intersection, (_, _, phases) in self._intersections.items()}
+
+    def _lane(self, route: List[str], position: int) -> str:
+        """Lane of route[position] which a vehicle drives in, for its turn onto the next road"""
+        road = route[position]
+        if position == len(route) - 1:
+            return f"{road}_{self._roads[road][1] // 2}"
+        _, links, _ = self._intersections[self._roads[road][2]]
+        return f"{road}_{links[(road, route[position + 1])][1]}"
+
+    def _has_room(self, lane: str) -> bool:
+        vehicles = self._lane_vehicles[lane]
+        return not vehicles or self._vehicles[vehicles[-1]][2] >= self._vehicles[vehicles[-1]][4]
+
+    def _is_green(self, intersection: str, link) -> bool:
+        virtual, links, phases = self._intersections[intersection]
+        if virtual:
+            return True
+        if not phases:
+            return False
+        return link in links and links[link][0] in phases[self._lights[intersection][0]][1]
+
+    def next_step(self) -> None:
+        # New vehicles queue to enter the start of their route
+        for i, flow in enumerate(self._flows):
+            end_time = flow.get("endTime", -1)
+            while True:
+                spawn_time = flow.get("startTime", 0) + self._spawned[i] * flow["interval"]
+                if spawn_time > self._time or 0 <= end_time < spawn_time:
+                    break
+                vehicle = flow["vehicle"]
+                vehicle_id = f"flow_{i}_{self._spawned[i]}"
+                self._vehicles[vehicle_id] = [flow["route"], 0, 0.0, 0.0, vehicle["length"] + vehicle["minGap"],
+                                              vehicle["maxSpeed"], False]
+                self._waiting.setdefault(self._lane(flow["route"], 0), deque()).append(vehicle_id)
+                self._num_waiting += 1
+                self._spawned[i] += 1
+
+        # Each lane is moved front to back, so that vehicles can only close up to where the vehicle ahead now is.
+        # Vehicles crossing an intersection join their next lane after every lane has moved.
+        used_links = set()
+        crossing = []
+        for lane, vehicles in self._lane_vehicles.items():
+            limit = math.inf
+            kept = []
+            for vehicle_id in vehicles:
+                route, position, distance, _, gap, max_speed, _ = vehicle = self._vehicles[vehicle_id]
+                road = route[position]
+                length, _, end = self._roads[road]
+
+                travelled = distance + max_speed * self._interval
+                if travelled >= length and limit == math.inf:
+                    if position == len(route) - 1:
+                        del self._vehicles[vehicle_id]
+                        continue
+                    link = (road, route[position + 1])
+                    next_lane = self._lane(route, position + 1)
+                    if link not in used_links and self._is_green(end, link) and self._has_room(next_lane):
+                        used_links.add(link)
+                        vehicle[1], vehicle[2], vehicle[3] = position + 1, 0.0, max_speed
+                        crossing.append((next_lane, vehicle_id))
+                        continue
+
+                new_distance = travelled if travelled < length else length
+                if new_distance > limit:
+                    new_distance = limit
+                if new_distance > distance:
+                    vehicle[2], vehicle[3] = new_distance, (new_distance - distance) / self._interval
+                else:
+                    vehicle[3] = 0.0
+                limit = vehicle[2] - gap
+                kept.append(vehicle_id)
+            vehicles[:] = kept
+
+        for lane, vehicle_id in crossing:
+            self._lane_vehicles[lane].append(vehicle_id)
+
+        # The first vehicle waiting for each lane enters it, if it has room
+        for lane, queue in self._waiting.items():
+            if queue and self._has_room(lane):
+                vehicle_id = queue.popleft()
+                self._vehicles[vehicle_id][6] = True
+                self._lane_vehicles[lane].append(vehicle_id)
+                self._num_waiting -= 1
+
+        if not self._rl_traffic_light:
+            for intersection, (virtual, _, phases) in self._intersections.items():
+                if virtual or not phases:
+                    continue
+                light = self._lights[intersection]
+                light[1] -= self._interval
+                while light[1] <= 0:
+                    light[0] = (light[0] + 1) % len(phases)
+                    light[1] += phases[light[0]][0]
+
+        if self._replay is not None:
+            self._replay.write(",".join(f"{vehicle_id} {self._vehicles[vehicle_id][0][self._vehicles[vehicle_id][1]]} "
+                                        f"{self._vehicles[vehicle_id][2]:.2f}"
+                                        for vehicles in self._lane_vehicles.values() for vehicle_id in vehicles) + ";\n")
+
+        self._time += self._interval
+
+    def set_tl_phase(self, intersection_id: str, phase_id: int) -> None:
+        self._lights[intersection_id][0] = phase_id
+
+    def get_vehicles(self, include_waiting: bool = False) -> List[str]:
+        if include_waiting:
+            return list(self._vehicles)
+        return [vehicle_id for vehicle_id, vehicle in self._vehicles.items() if vehicle[6]]
+
+    def get_vehicle_count(self) -> int:
+        return len(self._vehicles) - self._num_waiting
+
+    def get_vehicle_info(self, vehicle_id: str) -> Dict[str, str]:
+        route, position, distance, speed, _, _, running = self._vehicles[vehicle_id]
+        if not running:
+            return {"running": "0"}
+        return {
+            "running": "1",
+            "speed": str(speed),
+            "distance": str(distance),
+            "drivable": self._lane(route, position),
+            "road": route[position],
+            "route": " ".join(route[position:]) + " "
+        }
+
+    def get_vehicle_speed(self) -> Dict[str, float]:
+        return {vehicle_id: self._vehicles[vehicle_id][3]
+                for vehicles in self._lane_vehicles.values() for vehicle_id in vehicles}
+
+    def get_lane_vehicle_count(self) -> Dict[str, int]:
+        return {lane: len(vehicles) for lane, vehicles in self._lane_vehicles.items()}
+
+    def get_lane_waiting_vehicle_count(self) -> Dict[str, int]:
+        return {lane: sum(self._vehicles[vehicle_id][3] < 0.1 for vehicle_id in vehicles)
+                for lane, vehicles in self._lane_vehicles.items()}
+
+    def get_lane_vehicles(self) -> Dict[str, List[str]]:
+        return {lane: list(vehicles) for lane, vehicles in self._lane_vehicles.items()}
+
+    def get_current_time(self) -> float:
+        return self._time
+
+    def snapshot(self):
+        return copy.deepcopy((self._time, self._vehicles, self._lane_vehicles, self._waiting, self._num_waiting,
+                              self._spawned, self._lights))
+
+    def load(self, archive) -> None:
+        (self._time, self._vehicles, self._lane_vehicles, self._waiting, self._num_waiting, self._spawned,
+         self._lights) = copy.deepcopy(archive)
+
+    def __del__(self):
+        if getattr(self, "_replay", None) is not None:
+            self._replay.close()
@@ -0,0 +1,53 @@
+"""
+Compares computing the lane link curves of every intersection of a grid one at a time, with find_path, against a single
+batch with find_paths, and checks that both give identical points.
+
+Run from the repository root with:
+
+    python -m benchmarks.geometry --sizes 10 30 50
+"""
+import argparse
+import time
+
+from CityFlow.tools.generator.generate_json_from_grid import pointToDict3
+from simulation_builder.geometry import find_path, find_paths
+from simulation_builder.graph import Road, grid_graph
+
+
+def lane_links(g):
+    """Every (in_road, in_lane, out_road, out_lane) lane link of g's intersections, as gen_road_links creates them"""
+    links = []
+    for u in g:
+        if len(g[u]) > 1:
+            for v in g[u]:
+                for w in g[u]:
+                    if v != w:
+                        links += [(Road(v, u), in_lane, Road(u, w), out_lane)
+                                  for in_lane in range(3) for out_lane in range(3)]
+    return links
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 30, 50])
+    parser.add_argument("--intersection-width", type=float, default=50)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        links = lane_links(grid_graph(size, size))
+
+        start = time.perf_counter()
+        single = [find_path(*link, args.intersection_width) for link in links]
+        single_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = find_paths(links, args.intersection_width)
+        batch_time = time.perf_counter() - start
+
+        identical = all(list(map(pointToDict3, points)) == path for points, path in zip(batched.tolist(), single))
+        print(f"grid={size:4d}x{size:<4d} lane links={len(links):8d}  find_path={single_time * 1000:9.2f}ms  "
+              f"find_paths={batch_time * 1000:9.2f}ms  speedup={single_time / batch_time:7.1f}x  identical={identical}")
+
+
+if __name__ == "__main__":
+    main()
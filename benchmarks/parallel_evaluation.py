@@ -0,0 +1,44 @@
+"""
+Measures the speedup of Emulator.grid_search_opt on I_graph() as the number of worker processes increases.
+
+Run from the repository root with:
+
+    python -m benchmarks.parallel_evaluation --workers 1 2 4 8 16 32
+"""
+import argparse
+import os
+import time
+
+from emulation.emulator import Emulator
+from metrics.metrics import CompletedJourneysMetric
+from simulation_builder.flows import FlowStrategy
+from simulation_builder.graph import I_graph
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count()])
+    parser.add_argument("--steps-per-axis", type=int, default=2)
+    parser.add_argument("--simulation-iterations", type=int, default=1000)
+    args = parser.parse_args()
+
+    baseline_time, baseline_df = None, None
+    for workers in args.workers:
+        e = Emulator(I_graph(), FlowStrategy(), simulation_iterations=args.simulation_iterations,
+                     fixed_time_period=60, workers=workers)
+
+        start = time.perf_counter()
+        df = e.grid_search_opt(CompletedJourneysMetric, interval=(0.1, 20), steps_per_axis=args.steps_per_axis)
+        elapsed = time.perf_counter() - start
+
+        if baseline_time is None:
+            baseline_time, baseline_df = elapsed, df
+        matches = df.equals(baseline_df)
+
+        print(f"workers={workers:3d}  candidates={len(df):5d}  time={elapsed:8.2f}s  "
+              f"speedup={baseline_time / elapsed:6.2f}x  efficiency={baseline_time / elapsed / workers:6.1%}  "
+              f"matches_serial={matches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Measures how all_pairs_shortest_paths scales with the size of the graph, on square grids of intersections with an
+endpoint on each border road. Shortest path trees and the routes built from them are timed separately, since routes
+are only built as they are looked up.
+
+Run from the repository root with:
+
+    python -m benchmarks.routing --sizes 10 30 50 100
+"""
+import argparse
+import time
+
+from simulation_builder.flows import all_pairs_shortest_paths
+from simulation_builder.graph import grid_graph
+
+
+def time_routing(g, weighted: bool):
+    paths = all_pairs_shortest_paths(g, weighted)
+
+    start = time.perf_counter()
+    trees = [routes for _, routes in paths.items()]
+    tree_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    num_routes = sum(len(route) > 0 for routes in trees for route in routes.values())
+    route_time = time.perf_counter() - start
+
+    return tree_time, route_time, num_routes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 30, 50, 100])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        g = grid_graph(size, size)
+        for weighted in (False, True):
+            tree_time, route_time, num_routes = time_routing(g, weighted)
+            print(f"vertices={len(g.keys()):6d}  weighted={weighted!s:5}  trees={tree_time * 1000:9.2f}ms  "
+                  f"routes={route_time * 1000:9.2f}ms  ({num_routes} routes)")
+
+
+if __name__ == "__main__":
+    main()
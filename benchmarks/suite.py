@@ -0,0 +1,195 @@
+"""
+Microbenchmarks of each stage of an evaluation - roadnet and flow generation, lane link geometry, routing, metric
+updates and results tables - and of end-to-end Simulator.evaluate. Simulations run on benchmarks.fake_engine, so the
+suite only needs CityFlow's Python generator tools, not the compiled cityflow module.
+
+Timings are written to a JSON file, along with the commit they were measured at, and can be compared against the
+results of an earlier run to spot regressions between commits.
+
+Run from the repository root with:
+
+    python -m benchmarks.suite --output benchmarks/results/new.json --compare benchmarks/results/old.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from benchmarks.fake_engine import FakeEngine
+from benchmarks.geometry import lane_links
+from emulation.artifacts import ArtifactCache
+from emulation.simulator import Simulator
+from emulation.utils import results_to_df
+from metrics.metrics import Metric
+from metrics.observation import Observation
+from simulation_builder.compact import CompactGraph
+from simulation_builder.flows import FlowStrategy, all_pairs_shortest_paths, graph_to_flow
+from simulation_builder.geometry import find_path, find_paths
+from simulation_builder.graph import grid_graph
+from simulation_builder.roadnets import gen_intersections, graph_to_roadnet
+
+
+def measure(run: Callable[[], None], setup: Callable[[], None] = lambda: None, repeat: int = 5) -> Dict:
+    """
+    Times repeat calls of run, each after an (untimed) call of setup, returning the min, median and mean time in
+    seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {"repeat": repeat, "min": min(times), "median": statistics.median(times), "mean": statistics.mean(times)}
+
+
+def metric_classes():
+    """Every concrete Metric subclass"""
+    classes, pending = [], list(Metric.__subclasses__())
+    while pending:
+        cls = pending.pop(0)
+        pending += cls.__subclasses__()
+        if not getattr(cls, "__abstractmethods__", None):
+            classes.append(cls)
+    return classes
+
+
+def time_metric_updates(metric_cls, config_file: str, steps: int, repeat: int) -> Dict:
+    """Times only the metric's updates over a fake engine simulation, with a fresh Observation each step"""
+    times = []
+    for _ in range(repeat):
+        eng = FakeEngine(config_file)
+        metric = metric_cls()
+        elapsed = 0.0
+        for _ in range(steps):
+            eng.next_step()
+            observation = Observation(eng)
+            start = time.perf_counter()
+            metric.update(observation)
+            elapsed += time.perf_counter() - start
+        times.append(elapsed)
+    return {"repeat": repeat, "min": min(times), "median": statistics.median(times), "mean": statistics.mean(times)}
+
+
+def run_suite(size: int, steps: int, repeat: int, scratch: str) -> Dict[str, Dict]:
+    """Runs every benchmark on a size x size grid, returning each one's timings and parameters"""
+    results = {}
+
+    def record(name: str, timings: Dict, **params):
+        results[name] = dict(timings, params=dict(params, size=size))
+        print(f"{name:40s} median={timings['median'] * 1000:10.3f}ms  min={timings['min'] * 1000:10.3f}ms")
+
+    # Each run starts from a new graph, so that nothing derived from it is cached
+    graphs = []
+    fresh_graph = lambda: graphs.append(grid_graph(size, size))
+    record("graph_to_roadnet", measure(lambda: graph_to_roadnet(graphs[-1]), fresh_graph, repeat))
+    record("graph_to_roadnet_cached", measure(lambda: graph_to_roadnet(graphs[-1]), repeat=repeat))
+    record("gen_intersections", measure(lambda: gen_intersections(graphs[-1], None), fresh_graph, repeat))
+
+    links = lane_links(grid_graph(size, size))
+    record("find_path", measure(lambda: [find_path(*link, 50) for link in links], repeat=repeat), links=len(links))
+    record("find_paths", measure(lambda: find_paths(links, 50), repeat=repeat), links=len(links))
+
+    record("all_pairs_shortest_paths",
+           measure(lambda: [list(routes.values()) for routes in all_pairs_shortest_paths(graphs[-1]).values()],
+                   fresh_graph, repeat))
+    record("graph_to_flow", measure(lambda: graph_to_flow(graphs[-1], FlowStrategy()), fresh_graph, repeat))
+
+    g = CompactGraph.from_graph(grid_graph(size, size))
+    num_params = len(g.intersections) * 3
+    rng = np.random.default_rng(42)
+    x = rng.uniform(0.1, 20, size=(1000, num_params))
+    y = rng.uniform(size=(1000, 2))
+    record("results_to_df", measure(lambda: results_to_df(x, y, ["a", "b"], 60), repeat=repeat),
+           rows=len(x), params=num_params)
+
+    artifacts = ArtifactCache(root=os.path.join(scratch, "artifacts"))
+    metrics = metric_classes()
+    for persistent_engine in (False, True):
+        sim = Simulator(g, metrics, timing_period=60, steps=steps, artifacts=artifacts,
+                        persistent_engine=persistent_engine, engine_factory=FakeEngine)
+        name = "evaluate_persistent" if persistent_engine else "evaluate"
+        record(name, measure(lambda: sim.evaluate(x[0]), repeat=repeat), steps=steps)
+
+    # The metrics are updated from a simulation under the default timings
+    config_file = sim._write_config(graph_to_roadnet(g), graph_to_flow(g, FlowStrategy()))
+    for metric_cls in metrics:
+        record(f"{metric_cls.__name__}.update", time_metric_updates(metric_cls, config_file, steps, repeat),
+               steps=steps)
+
+    return results
+
+
+def commit() -> Optional[str]:
+    """The checked out commit, or None if it can't be found"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict[str, Dict], previous: Dict[str, Dict], threshold: float) -> int:
+    """
+    Prints the ratio of each benchmark's median time to its previous median, returning the number of benchmarks
+    which slowed down by more than the threshold ratio.
+    """
+    regressions = 0
+    for name, timings in results.items():
+        if name not in previous:
+            continue
+        if timings["params"] != previous[name]["params"]:
+            print(f"{name:40s} skipped - parameters differ")
+            continue
+
+        ratio = timings["median"] / previous[name]["median"]
+        regressed = ratio > threshold
+        regressions += regressed
+        print(f"{name:40s} {ratio:6.2f}x previous{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=5, help="Rows and columns of the benchmarked grid")
+    parser.add_argument("--steps", type=int, default=200, help="Steps of each simulation")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="JSON file to write results to")
+    parser.add_argument("--compare", help="JSON results of an earlier run, to compare against")
+    parser.add_argument("--threshold", type=float, default=1.1,
+                        help="Ratio to the earlier median above which a benchmark counts as a regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        results = run_suite(args.size, args.steps, args.repeat, scratch)
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            f.write(json.dumps({
+                "commit": commit(),
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "benchmarks": results
+            }, indent=4))
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            previous = json.loads(f.read())
+        print(f"\nCompared with {previous.get('commit')}:")
+        if compare(results, previous["benchmarks"], args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
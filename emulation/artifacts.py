@@ -0,0 +1,176 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import socket
+import tempfile
+from collections import OrderedDict
+from multiprocessing.util import Finalize
+from typing import Dict, Iterable, Optional
+
+from simulation_builder.serialization import JSONWriter
+
+# Lock files of the scratch directories of this process, by directory - shared by every cache in the process, and
+# never closed, as closing any file descriptor of a locked file releases the process' lock on it
+_locks = {}
+
+
+class ArtifactCache:
+    """
+    Content-addressed store for the roadnet, flow and config files handed to CityFlow.
+
+    Each document is serialised and hashed, and only kept on disk if no file with the same contents is already
+    cached. Files are kept in a scratch directory per process, so that concurrent workers never read each other's
+    partially written files, and evicted least recently used first once the cache exceeds its size limits. Each
+    process' directory is removed when it exits, and holds a lock file while the process is alive, so that directories
+    left behind by killed processes can be told apart from those in use - even by other hosts sharing the root.
+    """
+
+    def __init__(self, root: Optional[str] = None, use_shm: bool = False, max_bytes: Optional[int] = None,
+                 max_files: Optional[int] = 64, writer: Optional[JSONWriter] = None):
+        """
+        Parameters
+        ----------
+        root:       Directory to create per-worker scratch directories in. Defaults to cityflow_config/cache, or
+                    /dev/shm/flowrence if use_shm is set.
+        use_shm:    Whether to keep artifacts in shared memory (/dev/shm) rather than on disk.
+        max_bytes:  Optional limit on the total size of cached files per worker.
+        max_files:  Optional limit on the number of cached files per worker.
+        writer:     JSON writer to serialise documents with - defaults to compact JSON, from the json module.
+        """
+        if root is None:
+            root = "/dev/shm/flowrence" if use_shm else "cityflow_config/cache"
+
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._writer = JSONWriter() if writer is None else writer
+
+        self._pid = None
+        self._index = OrderedDict()
+        self._size = 0
+
+    @property
+    def directory(self) -> str:
+        """Scratch directory of the current process"""
+        pid = os.getpid()
+        directory = os.path.join(self.root, f"worker_{socket.gethostname()}_{pid}")
+        if pid != self._pid:
+            # Forked workers start with an empty cache of their own, rather than sharing their parent's files
+            self._pid = pid
+            self._index = OrderedDict()
+            self._size = 0
+
+            # Any directories left behind by processes which were killed are removed, and this process' directory is
+            # locked until it exits, then removed - including in pool workers, which skip atexit handlers
+            self._remove_stale(directory)
+            _lock(directory)
+            Finalize(None, shutil.rmtree, args=(directory,), kwargs={"ignore_errors": True}, exitpriority=0)
+        return directory
+
+    def _remove_stale(self, directory: str) -> None:
+        """
+        Removes the scratch directories whose lock file isn't locked - as the lock is released when a process exits
+        however it exits, these belong to processes which no longer exist, on any host
+        """
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            lock_path = os.path.join(path, ".lock")
+            # Directories without a lock file are still being created, and the process' own directory would seem
+            # unlocked, as a process can always take its own locks
+            if not name.startswith("worker_") or path == directory or not os.path.exists(lock_path):
+                continue
+            try:
+                with open(lock_path, 'a') as f:
+                    fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                # Locked by a live process, or removed by another process in the meantime
+                pass
+
+    def path(self, kind: str, document) -> str:
+        """
+        Parameters
+        ----------
+        kind:       Type of document (e.g. "roadnet"), used as the file name prefix
+        document:   JSON serialisable document
+
+        Returns
+        -------
+        Path to a file containing the document, which is only kept if it is not already cached.
+        """
+        directory = self.directory
+        os.makedirs(directory, exist_ok=True)
+
+        # The document is hashed as it is encoded, so that it is never held in memory whole, and only written to disk
+        # if it isn't already cached
+        digest = hashlib.sha1()
+        size = 0
+        for chunk in self._writer.chunks(document):
+            digest.update(chunk)
+            size += len(chunk)
+
+        path = os.path.join(directory, f"{kind}_{digest.hexdigest()[:16]}.json")
+        if path not in self._index and not os.path.exists(path):
+            # Streamed to a temporary file which is renamed into place, so that the cached file is never seen half
+            # written
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{kind}_", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    self._writer.dump(document, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+        if path in self._index:
+            self._index.move_to_end(path)
+        else:
+            self._index[path] = size
+            self._size += size
+        return path
+
+    def evict(self, keep: Iterable[str] = ()) -> None:
+        """Removes least recently used files until the cache is within its limits, except for those in keep"""
+        keep = set(keep)
+        for path in list(self._index):
+            if not self._over_limit():
+                break
+            if path in keep:
+                continue
+            self._size -= self._index.pop(path)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def clear(self) -> None:
+        """Removes the files in the current process' scratch directory"""
+        directory = self.directory
+        for name in os.listdir(directory):
+            if name != ".lock":
+                os.remove(os.path.join(directory, name))
+        self._index = OrderedDict()
+        self._size = 0
+
+    def _over_limit(self) -> bool:
+        return (self.max_bytes is not None and self._size > self.max_bytes) or \
+               (self.max_files is not None and len(self._index) > self.max_files)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def stats(self) -> Dict:
+        return {"files": len(self._index), "bytes": self._size}
+
+
+def _lock(directory: str) -> None:
+    """Creates a scratch directory, and locks its lock file for as long as the process is alive"""
+    os.makedirs(directory, exist_ok=True)
+    if directory not in _locks:
+        # POSIX record locks (unlike flock) aren't inherited by forked processes, and work on network filesystems. The
+        # lock file is locked before it is renamed into place, so that it is never seen unlocked
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".lock_", suffix=".tmp")
+        _locks[directory] = os.fdopen(fd, 'w')
+        fcntl.lockf(_locks[directory], fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.replace(tmp_path, os.path.join(directory, ".lock"))
@@ -0,0 +1,120 @@
+import functools
+import hashlib
+import json
+import sqlite3
+import types
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+
+def stable_repr(obj) -> str:
+    """
+    Returns a representation of obj that is the same between processes and runs - unlike hash(), and unlike repr() for
+    sets and objects without a custom __repr__. Functions and methods are represented by their qualified name (and
+    bound object), so lambdas and closures, which can't be told apart by name, raise a TypeError.
+    """
+    if isinstance(obj, dict):
+        return "{" + ", ".join(sorted(f"{stable_repr(k)}: {stable_repr(v)}" for k, v in obj.items())) + "}"
+    if isinstance(obj, (set, frozenset)):
+        return "{" + ", ".join(sorted(stable_repr(v) for v in obj)) + "}"
+    if isinstance(obj, (list, tuple)):
+        return "(" + ", ".join(stable_repr(v) for v in obj) + ")"
+    if isinstance(obj, functools.partial):
+        return f"partial({stable_repr(obj.func)}, {stable_repr(obj.args)}, {stable_repr(obj.keywords)})"
+    if isinstance(obj, type):
+        return f"{obj.__module__}.{obj.__qualname__}"
+    if isinstance(obj, types.MethodType):
+        return f"{stable_repr(obj.__self__)}.{obj.__func__.__qualname__}"
+    if isinstance(obj, types.BuiltinMethodType) and not isinstance(obj.__self__, (types.ModuleType, type(None))):
+        return f"{stable_repr(obj.__self__)}.{obj.__name__}"
+    if isinstance(obj, (types.FunctionType, types.BuiltinFunctionType)):
+        # Functions are identified by name, which can't tell apart lambdas, or closures over different values
+        if "<lambda>" in obj.__qualname__ or "<locals>" in obj.__qualname__ or \
+                getattr(obj, "__closure__", None) is not None:
+            raise TypeError(f"{obj.__qualname__} can't be keyed stably - use a module level function or a "
+                            f"functools.partial of one instead")
+        return f"{obj.__module__}.{obj.__qualname__}"
+    if hasattr(obj, "__dict__"):
+        return f"{stable_repr(type(obj))}{stable_repr(vars(obj))}"
+    return repr(obj)
+
+
+def stable_hash(*parts) -> str:
+    return hashlib.sha256(stable_repr(parts).encode()).hexdigest()
+
+
+class EvaluationCache:
+    """
+    Memoizes simulation results, so that candidates which have already been simulated are not simulated again.
+
+    Results are kept in an in-memory LRU cache, in front of an (optional) SQLite database which persists them between
+    runs.
+    """
+
+    def __init__(self, path: Optional[str] = None, capacity: int = 4096):
+        """
+        Parameters
+        ----------
+        path:       Optional SQLite database file to persist results to. If not specified, results are only cached in
+                    memory.
+        capacity:   Number of results to keep in memory.
+        """
+        self.path = path
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+
+        self._lru = OrderedDict()
+        self._db = None
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if self.path is not None and self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS evaluations (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._db.commit()
+        return self._db
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Returns the cached result for key, or None if it has not been evaluated"""
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return self._lru[key]
+
+        db = self._connection()
+        if db is not None:
+            row = db.execute("SELECT value FROM evaluations WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                value = np.array(json.loads(row[0]))
+                self._remember(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: np.ndarray) -> None:
+        value = np.asarray(value, dtype=float)
+        self._remember(key, value)
+
+        db = self._connection()
+        if db is not None:
+            db.execute("INSERT OR REPLACE INTO evaluations VALUES (?, ?)", (key, json.dumps(value.tolist())))
+            db.commit()
+
+    def _remember(self, key: str, value: np.ndarray) -> None:
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+
+    def stats(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def __getstate__(self):
+        # SQLite connections can't be pickled - each process opens its own
+        state = self.__dict__.copy()
+        state["_db"] = None
+        return state
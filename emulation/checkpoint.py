@@ -0,0 +1,61 @@
+import json
+from dataclasses import dataclass
+from typing import Tuple
+
+import numpy as np
+
+from simulation_builder.serialization import atomic_write
+
+
+@dataclass
+class Checkpoint:
+    """
+    State of a Bayesian optimisation loop after an iteration: every evaluation made so far (and the steps each
+    simulation used), the hyperparameters of the GP model, and NumPy's global random state - everything needed to continue the loop as if it had never stopped.
+    """
+    iteration: int
+    X: np.ndarray
+    Y: np.ndarray
+    steps_used: np.ndarray
+    param_array: np.ndarray
+    random_state: Tuple
+
+    @staticmethod
+    def capture(loop, steps_used: np.ndarray) -> "Checkpoint":
+        """Checkpoint of an emukit loop, whose model wraps a GPy model, given the steps used by each of its evaluations"""
+        return Checkpoint(loop.loop_state.iteration, loop.loop_state.X, loop.loop_state.Y, steps_used,
+                          loop.model.model.param_array.copy(), np.random.get_state())
+
+    def restore(self, loop) -> None:
+        """
+        Restores the model hyperparameters, iteration count and random state to an emukit loop created with the
+        checkpoint's evaluations
+        """
+        loop.model.model[:] = self.param_array
+        loop.loop_state.iteration = self.iteration
+        np.random.set_state(self.random_state)
+
+    def save(self, path: str) -> None:
+        """Writes the checkpoint to a JSON file, replacing any earlier checkpoint atomically"""
+        name, keys, position, has_gauss, cached_gaussian = self.random_state
+        document = {
+            "iteration": self.iteration,
+            "X": self.X.tolist(),
+            "Y": self.Y.tolist(),
+            "steps_used": self.steps_used.tolist(),
+            "param_array": self.param_array.tolist(),
+            "random_state": [name, keys.tolist(), position, has_gauss, cached_gaussian]
+        }
+        with atomic_write(path) as f:
+            f.write(json.dumps(document).encode())
+
+    @staticmethod
+    def load(path: str) -> "Checkpoint":
+        with open(path, 'r') as f:
+            document = json.loads(f.read())
+
+        name, keys, position, has_gauss, cached_gaussian = document["random_state"]
+        return Checkpoint(document["iteration"], np.array(document["X"], dtype=float),
+                          np.array(document["Y"], dtype=float), np.array(document["steps_used"], dtype=int),
+                          np.array(document["param_array"], dtype=float),
+                          (name, np.array(keys, dtype=np.uint32), position, has_gauss, cached_gaussian))
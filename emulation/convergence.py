@@ -0,0 +1,46 @@
+from typing import List
+
+import numpy as np
+
+
+class SteadyStateDetector:
+    """
+    Decides when a simulation's metrics have reached a steady state, so that it can be stopped early.
+
+    The metrics' aggregates are estimated at the end of every batch of batch_size steps. Once at least min_steps have
+    been simulated, the simulation has converged if the estimates from the last num_batches batches all lie within
+    tolerance (relative to their mean) of each other, for every metric.
+    """
+
+    def __init__(self, tolerance: float = 0.01, min_steps: int = 200, batch_size: int = 50, num_batches: int = 5):
+        """
+        Parameters
+        ----------
+        tolerance:      Maximum relative range of the last num_batches estimates of each metric
+        min_steps:      Minimum number of steps to simulate before checking for convergence
+        batch_size:     Number of steps between estimates of the metrics
+        num_batches:    Number of consecutive estimates which must agree
+        """
+        self.tolerance = tolerance
+        self.min_steps = min_steps
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+
+    def converged(self, estimates: List[np.ndarray], steps: int) -> bool:
+        """
+        Parameters
+        ----------
+        estimates:  Estimates of the metrics' aggregates, taken at the end of each batch so far
+        steps:      Number of steps simulated so far
+
+        Returns
+        -------
+        Whether the metrics have converged, and the simulation can be stopped.
+        """
+        if steps < self.min_steps or len(estimates) < self.num_batches:
+            return False
+
+        recent = np.array(estimates[-self.num_batches:])
+        spread = recent.max(axis=0) - recent.min(axis=0)
+        scale = np.maximum(np.abs(recent.mean(axis=0)), 1e-12)
+        return bool(np.all(spread <= self.tolerance * scale))
@@ -1,59 +1,736 @@
-from typing import Tuple, Optional
+import functools
+import heapq
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
+from typing import Callable, Tuple, Optional, Union
 
+import GPy
 import numpy as np
-import scipy
-from emukit.core import ContinuousParameter
+import pandas
+from emukit.bayesian_optimization.acquisitions.entropy_search import MultiInformationSourceEntropySearch
+from emukit.core import ContinuousParameter, InformationSourceParameter, ParameterSpace
+from emukit.core.acquisition import Acquisition
+from emukit.core.loop import FixedIntervalUpdater, OuterLoop, SequentialPointCalculator
+from emukit.core.loop.candidate_point_calculators import GreedyBatchPointCalculator
+from emukit.core.loop.loop_state import create_loop_state
+from emukit.core.optimization import GradientAcquisitionOptimizer, MultiSourceAcquisitionOptimizer
 from emukit.examples.gp_bayesian_optimization.single_objective_bayesian_optimization import GPBayesianOptimization
+from emukit.model_wrappers import GPyMultiOutputWrapper
+from emukit.multi_fidelity.kernels import LinearMultiFidelityKernel
+from emukit.multi_fidelity.models import GPyLinearMultiFidelityModel
 
+from emulation.cache import EvaluationCache, stable_hash
+from emulation.checkpoint import Checkpoint
+from emulation.convergence import SteadyStateDetector
+from emulation.engines import Engine
+from emulation.grid import Grid, append_results, claim_results, read_results
+from emulation.profiling import Profiler
+from emulation.queue_model import QueueSimulator
 from emulation.simulator import Simulator
-from emulation.utils import results_to_df
+from emulation.utils import df_to_x, independent_blocks, pareto_front, results_to_df
 
+from simulation_builder.compact import CompactGraph
 from simulation_builder.flows import FlowStrategy
 from simulation_builder.graph import Graph
 
+# Simulator shared by every task of a worker process, installed once by the pool initializer so that it is not
+# pickled again for each candidate.
+_worker_simulator: Optional[Simulator] = None
+
+
+def _init_worker(simulator: Simulator):
+    global _worker_simulator
+    _worker_simulator = simulator
+
+
+def _simulate_in_worker(x, steps):
+    return _worker_simulator.simulate(x, steps)
+
+
+class _FidelityCost(Acquisition):
+    """Cost of evaluating points, given by the number of steps simulated at each point's fidelity (its last column)"""
+
+    def __init__(self, costs: Tuple[float, ...]):
+        self._costs = np.array(costs, dtype=float)
+
+    def evaluate(self, x: np.ndarray) -> np.ndarray:
+        return self._costs[x[:, -1].astype(int)][:, np.newaxis]
+
+    @property
+    def has_gradients(self) -> bool:
+        return True
+
+    def evaluate_with_gradients(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return self.evaluate(x), np.zeros(x.shape)
+
 
 class Emulator:
     def __init__(self, graph: Graph, flow_strategy: FlowStrategy, simulation_iterations: int = 1000,
-                 fixed_time_period: Optional[float] = None):
-        self._g = graph
+                 fixed_time_period: Optional[float] = None, workers: int = 1,
+                 cache: Optional[EvaluationCache] = None, persistent_engine: bool = False, warmup: int = 0,
+                 steady_state: Optional[SteadyStateDetector] = None, profiler: Optional[Profiler] = None,
+                 engine_factory: Optional[Callable[..., Engine]] = None):
+        """
+        Parameters
+        ----------
+        graph:                  Graph of roadnet to optimise traffic light timings for
+        flow_strategy:          Flow strategy for the simulation - defaults to uniform flow
+        simulation_iterations:  Number of steps to run each simulation for
+        fixed_time_period:      Optional fixed duration for a full traffic light cycle
+        workers:                Number of processes to evaluate candidate timings on. If greater than one, batches of
+                                candidates are fanned out to a process pool, with one simulation per process.
+        cache:                  Optional cache of evaluation results, consulted before simulating each candidate.
+        persistent_engine:      Whether simulators should reuse a single engine per process (see Simulator).
+        warmup:                 Number of steps of each simulation to share between candidates as a warm-up, before
+                                metrics are collected (see Simulator).
+        steady_state:           Optional detector to end simulations early once their metrics converge. When set, the
+                                number of steps each evaluation actually used is reported in a "steps_used" column.
+        profiler:               Optional profiler to collect the profile of every simulation into, across all of the
+                                emulator's optimisation runs (including those run in worker processes). Its summary
+                                shows which stage of evaluation dominates, e.g. engine steps or roadnet generation.
+        engine_factory:         Optional callable creating the simulation engine, in place of CityFlow's (see
+                                Simulator).
+        """
+        self._g = CompactGraph.from_graph(graph)
         self._strategy = FlowStrategy() if flow_strategy is None else flow_strategy
         self._sim_iterations = simulation_iterations
         self._time_period = fixed_time_period
+        self._workers = workers
+        self.cache = cache
+        self._persistent_engine = persistent_engine
+        self._warmup = warmup
+        self._steady_state = steady_state
+        self._engine_factory = engine_factory
+        self.profiler = profiler
+        self._pool = None
 
-        intersections = len([v for v in self._g if len(self._g[v]) > 2])
+        intersections = len(self._g.intersections)
 
         if self._time_period is None:
             self._num_params = intersections * 4
         else:
             self._num_params = intersections * 3
 
-    def bayes_opt(self, metric, interval: Tuple[float, float], iterations: int):
+    def bayes_opt(self, metric, interval: Tuple[float, float], iterations: int, batch_size: int = 1,
+                  batch_method: str = "local_penalization", checkpoint: Optional[str] = None,
+                  resume_from: Optional[str] = None):
+        """
+        Parameters
+        ----------
+        metric:         Metric class to minimise
+        interval:       Range of values for each phase timing
+        iterations:     Number of iterations of the optimisation loop - when resuming, including those already run
+        batch_size:     Number of points to propose in each iteration. Each batch is simulated concurrently, so should
+                        usually match the number of workers.
+        batch_method:   How batches are chosen - "local_penalization", or "kriging_believer" to add each point to the
+                        model at its predicted mean before choosing the next.
+        checkpoint:     Optional JSON file to save the loop's state to after every iteration - every evaluation so far
+                        and the model's hyperparameters - so that the run can be resumed if it dies
+        resume_from:    Optional checkpoint to resume an interrupted run from, with the same arguments. Its evaluations
+                        are not simulated again, and the run continues as it would have without the interruption.
+
+        Returns
+        -------
+        Dataframe of every evaluation made.
+        """
+        if isinstance(metric, (list, tuple)):
+            raise ValueError("Bayesian optimisation takes a single metric - use pareto_opt for multiple metrics")
+        if batch_method not in ("local_penalization", "kriging_believer"):
+            raise ValueError(f"Unknown batch method {batch_method}")
+
+        np.random.seed(42)
+
+        resumed = None
+        if resume_from is not None:
+            resumed = Checkpoint.load(resume_from)
+            if resumed.X.shape[1] != self._num_params:
+                raise ValueError(f"{resume_from} checkpoints a run with {resumed.X.shape[1]} parameters, not "
+                                 f"{self._num_params}")
+
+        sim = self._simulator(metric)
+        steps_used = []
+
+        def evaluate(x):
+            y, used = self._run_batch(sim, x)
+            steps_used.extend(used)
+            return y
+
+        with self._worker_pool(sim):
+            if resumed is None:
+                x_init = np.random.uniform(*interval, size=(1, self._num_params))
+                y_init = evaluate(x_init)
+            else:
+                x_init, y_init = resumed.X, resumed.Y
+                steps_used.extend(resumed.steps_used)
+
+            parameter_list = [ContinuousParameter(f"p{i}", *interval) for i in range(self._num_params)]
+
+            bo_loop = GPBayesianOptimization(variables_list=parameter_list, X=x_init, Y=y_init, noiseless=True,
+                                             batch_size=batch_size)
+            if batch_method == "kriging_believer" and batch_size > 1:
+                bo_loop.candidate_point_calculator = GreedyBatchPointCalculator(
+                    bo_loop.model, bo_loop.acquisition, GradientAcquisitionOptimizer(bo_loop.space), batch_size)
+
+            if resumed is not None:
+                resumed.restore(bo_loop)
+            if checkpoint is not None:
+                bo_loop.iteration_end_event.append(
+                    lambda loop, _: Checkpoint.capture(loop, np.array(steps_used)).save(checkpoint))
+
+            # The loop stops once its iteration count (which continues from any checkpoint) reaches iterations
+            bo_loop.run_optimization(evaluate, iterations)
+
+        df = results_to_df(bo_loop.model.X, bo_loop.model.Y, self._metric_name(metric), self._time_period)
+        return self._record_steps(df, steps_used)
+
+    def multi_fidelity_bayes_opt(self, metric, interval: Tuple[float, float], iterations: int,
+                                 fidelities: Optional[Tuple[int, ...]] = None, initial_points_per_fidelity: int = 2):
+        """
+        Bayesian optimisation with the simulation length as a fidelity parameter. A linear multi-fidelity GP models the
+        metric at each simulation length, and each iteration picks both the next timings and the number of steps to
+        simulate them for, by maximising entropy search per simulated step.
+
+        Parameters
+        ----------
+        metric:                         Metric class to minimise
+        interval:                       Range of values for each phase timing
+        iterations:                     Number of evaluations to make after the initial design
+        fidelities:                     Increasing numbers of steps to simulate at each fidelity - defaults to a quarter
+                                        of, and the full, number of simulation iterations.
+        initial_points_per_fidelity:    Number of random points to evaluate at each fidelity before optimising
+
+        Returns
+        -------
+        Dataframe with a row for every evaluation, where the "steps" column records the simulation length it was
+        evaluated at. The number of iterations and the total number of simulated steps are stored in the dataframe's
+        attrs.
+        """
+        if isinstance(metric, (list, tuple)):
+            raise ValueError("Bayesian optimisation takes a single metric - use pareto_opt for multiple metrics")
+
         np.random.seed(42)
 
-        sim = Simulator(self._g, metric, self._strategy, self._time_period, self._sim_iterations)
-        x_init = np.random.uniform(*interval, size=(1, self._num_params))
-        y_init = sim.evaluate(x_init)
+        if fidelities is None:
+            fidelities = (max(1, self._sim_iterations // 4), self._sim_iterations)
+        n_fidelities = len(fidelities)
 
+        sim = self._simulator(metric)
+
+        steps_used = []
+
+        def evaluate(x):
+            # The last column of x is the index of the fidelity to evaluate each point at
+            y = np.empty((len(x), 1))
+            used = np.empty(len(x), dtype=int)
+            for i, steps in enumerate(fidelities):
+                rows = x[:, -1] == i
+                if rows.any():
+                    y[rows], used[rows] = self._run_batch(sim, x[rows, :-1], steps)
+            steps_used.extend(used)
+            return y
+
+        x_init = np.hstack([np.random.uniform(*interval, size=(initial_points_per_fidelity * n_fidelities,
+                                                                self._num_params)),
+                            np.repeat(np.arange(n_fidelities), initial_points_per_fidelity)[:, np.newaxis]])
+        y_init = evaluate(x_init)
+
+        kernel = LinearMultiFidelityKernel([GPy.kern.RBF(self._num_params) for _ in range(n_fidelities)])
+        gpy_model = GPyLinearMultiFidelityModel(x_init, y_init, kernel, n_fidelities=n_fidelities)
+        # Simulations are deterministic, so fix noise as GPBayesianOptimization does with noiseless=True
+        for likelihood in gpy_model.likelihood.likelihoods_list:
+            likelihood.variance.constrain_fixed(0.001)
+        model = GPyMultiOutputWrapper(gpy_model, n_outputs=n_fidelities, n_optimization_restarts=1)
+
+        space = ParameterSpace([ContinuousParameter(f"p{i}", *interval) for i in range(self._num_params)] +
+                               [InformationSourceParameter(n_fidelities)])
+        acquisition = MultiInformationSourceEntropySearch(model, space) / _FidelityCost(fidelities)
+        optimizer = MultiSourceAcquisitionOptimizer(GradientAcquisitionOptimizer(space), space)
+
+        loop = OuterLoop(SequentialPointCalculator(acquisition, optimizer), FixedIntervalUpdater(model),
+                         create_loop_state(x_init, y_init))
+        with self._worker_pool(sim):
+            loop.run_loop(evaluate, iterations)
+
+        x, y = loop.loop_state.X, loop.loop_state.Y
+        df = results_to_df(x[:, :-1], y, self._metric_name(metric), self._time_period)
+        df["steps"] = np.array(fidelities)[x[:, -1].astype(int)]
+        self._record_steps(df, steps_used)
+        df.attrs["iterations"] = iterations
+        df.attrs["total_steps"] = int(df["steps_used" if self._steady_state is not None else "steps"].sum())
+        return df
+
+    def grid_search_opt(self, metric, interval: Tuple[float, float], steps_per_axis: int,
+                        chunk_size: Optional[int] = 256, results_file: Optional[str] = None, shard_index: int = 0,
+                        num_shards: int = 1):
+        """
+        Evaluates target_function on all combinations of parameters taken from the same interval. metric may be a list
+        of metric classes, in which case every metric is reported from a single simulation of each point.
+
+        The grid is generated and evaluated a chunk at a time, so it is never held in memory as a whole. Rows are in the
+        same order as scipy.optimize.brute would evaluate the grid, indexed by their point's position in it.
+
+        Parameters
+        ----------
+        metric:         Metric class (or list of metric classes) to evaluate
+        interval:       Range of values for each phase timing
+        steps_per_axis: Number of values of each phase timing in the grid
+        chunk_size:     Number of points to evaluate at a time, rounded up to a multiple of the number of workers so that
+                        none sit idle. None evaluates the whole grid (or shard) at once, holding all of it in memory.
+        results_file:   Optional CSV file to append each chunk's results to, as soon as it is evaluated. If the file
+                        already holds results (e.g. from a search which crashed), the search resumes after them. The
+                        search is recorded alongside, in a ".search" file, so that a different search (or the same
+                        grid with different metrics or simulations) refuses to resume from it.
+        shard_index:    Index of the shard of the grid to search, from 0 to num_shards - 1
+        num_shards:     Number of contiguous shards to split the grid into, e.g. to search it on several machines.
+                        Concatenating the results of every shard, in order, gives the results of the whole grid.
+
+        Returns
+        -------
+        Dataframe of the results of every point of the shard, including any read back from results_file.
+        """
+        np.random.seed(42)
+
+        sim = self._simulator(metric)
+
+        grid = Grid(interval, steps_per_axis, self._num_params)
+        indices = grid.shard(shard_index, num_shards)
+
+        # Columns of the rows this search writes
+        empty = results_to_df(np.zeros((0, self._num_params)), np.zeros((0, len(sim.metrics))),
+                              self._metric_name(metric), self._time_period)
+        columns = list(self._record_steps(empty, np.zeros(0)).columns)
+
+        done = None
+        if results_file is not None:
+            # Only a file this same search has written can be resumed - the search is identified by everything which
+            # determines its results, as a cache key does, and by its grid and shard
+            claim_results(results_file, stable_hash(sim.cache_key(np.zeros(0)), interval, steps_per_axis, shard_index,
+                                                    num_shards))
+            done = read_results(results_file)
+        if done is not None:
+            if not (list(done.columns) == columns and list(done.index) == list(indices[:len(done)]) and
+                    np.array_equal(df_to_x(done, self._time_period), grid.points(done.index.to_numpy()))):
+                raise ValueError(f"{results_file} holds the results of a different grid search")
+            indices = indices[len(done):]
+
+        chunks = [] if done is None else [done]
+        with self._worker_pool(sim):
+            chunk_size = max(len(indices), 1) if chunk_size is None else \
+                math.ceil(chunk_size / max(self._workers, 1)) * max(self._workers, 1)
+            for chunk, points in grid.chunks(indices, chunk_size):
+                results, steps_used = self._run_batch(sim, points)
+                df = self._record_steps(results_to_df(points, results, self._metric_name(metric), self._time_period),
+                                        steps_used)
+                df.index = chunk
+                if results_file is not None:
+                    append_results(results_file, df)
+                chunks.append(df)
+
+        if not chunks:
+            return pandas.DataFrame()
+        return pandas.concat(chunks)
+
+    def pareto_opt(self, metrics, interval: Tuple[float, float], iterations: int, initial_points: int = 5,
+                   rho: float = 0.05):
+        """
+        Multi-objective Bayesian optimisation (ParEGO). Every metric is calculated from the same simulation of each
+        candidate, and each iteration optimises a randomly weighted augmented Chebyshev scalarisation of the normalised
+        metrics, so that the evaluations spread out along the Pareto front.
+
+        Parameters
+        ----------
+        metrics:        List of metric classes to minimise
+        interval:       Range of values for each phase timing
+        iterations:     Number of iterations of the optimisation loop
+        initial_points: Number of random points to evaluate before optimising
+        rho:            Weight of the (augmenting) weighted sum in the scalarisation
+
+        Returns
+        -------
+        Dataframe of every evaluation made, with a column per metric, and a "pareto" column marking the evaluations
+        which are not dominated by any other.
+        """
+        np.random.seed(42)
+
+        sim = self._simulator(metrics)
         parameter_list = [ContinuousParameter(f"p{i}", *interval) for i in range(self._num_params)]
 
-        bo_loop = GPBayesianOptimization(variables_list=parameter_list, X=x_init, Y=y_init, noiseless=True)
-        bo_loop.run_optimization(sim.evaluate, iterations)
+        with self._worker_pool(sim):
+            x = np.random.uniform(*interval, size=(initial_points, self._num_params))
+            y, steps_used = self._run_batch(sim, x)
+
+            for _ in range(iterations):
+                weights = np.random.dirichlet(np.ones(len(metrics)))
+
+                # Normalise each metric to [0, 1] so that the weights are comparable
+                span = y.max(axis=0) - y.min(axis=0)
+                normalised = (y - y.min(axis=0)) / np.where(span > 0, span, 1)
+                scalarised = (normalised * weights).max(axis=1) + rho * (normalised * weights).sum(axis=1)
+
+                bo = GPBayesianOptimization(variables_list=parameter_list, X=x, Y=scalarised[:, np.newaxis],
+                                            noiseless=True)
+                x_new = bo.suggest_new_locations()
+
+                y_new, used = self._run_batch(sim, x_new)
+                x = np.vstack([x, x_new])
+                y = np.vstack([y, y_new])
+                steps_used = np.concatenate([steps_used, used])
 
-        return results_to_df(bo_loop.model.X, bo_loop.model.Y, metric().name, self._time_period)
+        df = results_to_df(x, y, self._metric_name(metrics), self._time_period)
+        df["pareto"] = pareto_front(y)
+        return self._record_steps(df, steps_used)
+
+    def halving_opt(self, metric, interval: Tuple[float, float], steps_per_axis: int, min_steps: int = 100,
+                    keep_fraction: float = 0.5):
+        """
+        Successive halving over the same grid as grid_search_opt. Every candidate is first simulated for a short run of
+        min_steps, and only the best keep_fraction of them are re-simulated with runs 1 / keep_fraction times longer,
+        repeating until the survivors have been simulated for the full number of simulation iterations. If metric is a
+        list of metric classes, candidates are ranked by the first.
+
+        Returns
+        -------
+        Dataframe with a row for every evaluation, where the "steps" column records the simulation length (fidelity)
+        it was evaluated at. The total number of simulated steps is stored in the dataframe's attrs.
+        """
+        if not 0 < keep_fraction < 1:
+            raise ValueError(f"keep_fraction must be between 0 and 1 (exclusive), not {keep_fraction}")
+        if min_steps < 1:
+            raise ValueError(f"min_steps must be at least 1, not {min_steps}")
+
+        np.random.seed(42)
+
+        sim = self._simulator(metric)
+        x = self._grid(interval, steps_per_axis)
+
+        steps = min(min_steps, self._sim_iterations)
+        rungs = []
+        with self._worker_pool(sim):
+            while True:
+                results, steps_used = self._run_batch(sim, x, steps)
+
+                df = results_to_df(x, results, self._metric_name(metric), self._time_period)
+                df["steps"] = steps
+                rungs.append(self._record_steps(df, steps_used))
+
+                if steps >= self._sim_iterations:
+                    break
+
+                # Metrics are minimised, so keep the candidates with the lowest results
+                survivors = max(1, math.ceil(len(x) * keep_fraction))
+                x = x[np.argsort(results[:, 0], kind="stable")[:survivors]]
+                # A lone survivor has nothing left to be ranked against, so goes straight to the full simulation
+                steps = self._sim_iterations if len(x) == 1 else \
+                    min(math.ceil(steps / keep_fraction), self._sim_iterations)
+
+        df = pandas.concat(rungs, ignore_index=True)
+        df.attrs["total_steps"] = int(df["steps_used" if self._steady_state is not None else "steps"].sum())
+        return df
+
+    def coordinate_descent_opt(self, metric, interval: Tuple[float, float], steps_per_axis: int, sweeps: int = 3,
+                               radius: int = 1):
+        """
+        Block coordinate descent, which scales to roadnets with many intersections by exploiting their locality. Each
+        intersection's timings are chosen to minimise its neighbourhood's contribution to the metric - the sum of the
+        contributions of the intersections within radius roads of it. Intersections whose neighbourhoods don't overlap
+        form a block, and are optimised together from the same simulations, so a sweep over the roadnet costs
+        steps_per_axis ** (timings per intersection) + 1 simulations per block, rather than per intersection.
+
+        Parameters
+        ----------
+        metric:         Metric class which reports its contributions by lane (e.g. LaneWaitingMetric), or a list of
+                        metric classes whose first does
+        interval:       Range of values for each phase timing
+        steps_per_axis: Number of values of each of an intersection's phase timings to try, as in grid_search_opt
+        sweeps:         Number of sweeps over every block of intersections
+        radius:         Number of roads within which intersections count as part of an intersection's neighbourhood
+
+        Returns
+        -------
+        Dataframe of every evaluation made, in order, with the sweep and block it was made for in "sweep" and "block"
+        columns. Timings start from the middle of the interval, and the last row evaluates the timings chosen by the
+        final sweep (with a sweep and block of -1).
+        """
+        np.random.seed(42)
+
+        ranked = metric[0] if isinstance(metric, (list, tuple)) else metric
+        if not hasattr(ranked.func if isinstance(ranked, functools.partial) else ranked, "contributions"):
+            raise ValueError(f"{ranked} doesn't report its contributions by lane, e.g. as LaneWaitingMetric does")
+        if self._num_params == 0:
+            raise ValueError("The roadnet has no traffic lights to optimise")
+
+        sim = self._simulator(metric)
+
+        # Intersections in the order their timings appear in a candidate, as Simulator.intersections
+        ids = sorted(self._g.intersections, key=lambda i: self._g.vertices[i])
+        hops = self._g.hops(ids)[:, ids]
+        neighbourhoods = hops <= radius
+        blocks = independent_blocks(hops, 2 * radius)
+
+        timings = self._num_params // len(ids)
+        local = np.mgrid[(slice(*interval, complex(steps_per_axis)),) * timings].reshape(timings, -1).T
+
+        x = np.full(self._num_params, (interval[0] + interval[1]) / 2)
+        evaluated, results, steps_used, sweep_column, block_column = [], [], [], [], []
+        with self._worker_pool(sim):
+            for sweep in range(sweeps):
+                for b, block in enumerate(blocks):
+                    # The first candidate keeps the current timings - the rest give each intersection of the block
+                    # every local choice, in a different order for each, so that no two choices are always evaluated
+                    # together
+                    candidates = np.repeat(x[np.newaxis], len(local) + 1, axis=0)
+                    for i in block:
+                        candidates[1:, i * timings:(i + 1) * timings] = local[np.random.permutation(len(local))]
+
+                    y, contributions, used = self._evaluate_contributions(sim, candidates)
+                    # Ties keep the current timings
+                    best = np.argmin(contributions @ neighbourhoods[block].T, axis=0)
+                    for i, row in zip(block, best):
+                        x[i * timings:(i + 1) * timings] = candidates[row, i * timings:(i + 1) * timings]
+
+                    evaluated.append(candidates)
+                    results.append(y)
+                    steps_used.append(used)
+                    sweep_column += [sweep] * len(candidates)
+                    block_column += [b] * len(candidates)
+
+            y, used = self._run_batch(sim, x[np.newaxis])
+            evaluated.append(x[np.newaxis])
+            results.append(y)
+            steps_used.append(used)
+            sweep_column.append(-1)
+            block_column.append(-1)
+
+        df = results_to_df(np.vstack(evaluated), np.vstack(results), self._metric_name(metric), self._time_period)
+        df["sweep"] = sweep_column
+        df["block"] = block_column
+        return self._record_steps(df, np.concatenate(steps_used))
+
+    def screen_opt(self, metric, interval: Tuple[float, float], steps_per_axis: int, shortlist: int = 10,
+                   saturation_flow: float = 0.5, chunk_size: int = 4096):
+        """
+        Screens the same grid as grid_search_opt with the (much faster, approximate) QueueSimulator, then simulates
+        only the best candidates of the screening with CityFlow. If metric is a list of metric classes, candidates are
+        ranked by the first. Only metrics the queue model supports (QueueSimulator.METRICS) can be screened for.
+
+        The grid is screened a chunk at a time, keeping only the best candidates so far, so neither the grid nor its
+        screening results are ever held in memory as a whole.
+
+        Parameters
+        ----------
+        metric:             Metric class (or list of metric classes) to minimise
+        interval:           Range of values for each phase timing
+        steps_per_axis:     Number of values of each phase timing in the grid
+        shortlist:          Number of the best screened candidates to simulate with CityFlow
+        saturation_flow:    Vehicles per second each road link discharges while green, in the queue model
+        chunk_size:         Number of points to screen at a time
+
+        Returns
+        -------
+        Dataframe with a row for each shortlisted candidate, best screened first and indexed by its point's position in
+        the grid, giving its CityFlow results in the metric columns and its queue model results in "screening_"
+        prefixed columns.
+        """
+        if shortlist < 1:
+            raise ValueError(f"shortlist must be at least 1, not {shortlist}")
 
-    def grid_search_opt(self, metric, interval: Tuple[float, float], steps_per_axis: int):
-        """Evaluates target_function on all combinations of parameters taken from the same interval"""
         np.random.seed(42)
 
-        sim = Simulator(self._g, metric, self._strategy, self._time_period, self._sim_iterations)
+        screen = QueueSimulator(self._g, metric, self._strategy, self._time_period, self._sim_iterations,
+                                warmup=self._warmup, saturation_flow=saturation_flow)
+        grid = Grid(interval, steps_per_axis, self._num_params)
+
+        # Heap of the best candidates screened so far, as (-result, -index, results), so that its root is the worst of
+        # them - ties are broken in favour of the earlier point, as a stable sort of the whole grid would
+        best = []
+        for chunk, points in grid.chunks(range(len(grid)), chunk_size):
+            screened, _ = self._run_batch(screen, points)
+            for i in np.argsort(screened[:, 0], kind="stable")[:shortlist]:
+                entry = (-screened[i, 0], -chunk[i], screened[i])
+                if len(best) < shortlist:
+                    heapq.heappush(best, entry)
+                else:
+                    heapq.heappushpop(best, entry)
+
+        best = sorted(best, reverse=True)
+        indices = np.array([-index for _, index, _ in best])
+        screened = np.vstack([results for _, _, results in best])
+
+        points = grid.points(indices)
+        sim = self._simulator(metric)
+        with self._worker_pool(sim):
+            results, steps_used = self._run_batch(sim, points)
+
+        df = results_to_df(points, results, self._metric_name(metric), self._time_period)
+        df.index = indices
+        names = self._metric_name(metric)
+        for i, name in enumerate(names if isinstance(names, list) else [names]):
+            df[f"screening_{name}"] = screened[:, i]
+        return self._record_steps(df, steps_used)
+
+    def replay_best(self, results: pandas.DataFrame, metric, n: int = 3, directory: str = "cityflow_config/replays",
+                    compress: bool = False) -> pandas.DataFrame:
+        """
+        Re-simulates the best candidates of an optimisation with CityFlow's replay enabled. Optimisations never save
+        replays themselves, so this is the only way to view a candidate in the CityFlow frontend.
+
+        Parameters
+        ----------
+        results:    Dataframe returned by one of the optimisation methods
+        metric:     Metric class (or list of metric classes) the results were optimised for. Candidates are ranked by
+                    the first, lowest first.
+        n:          Number of candidates to replay
+        directory:  Directory to write the replay files to. The replay of the i-th best candidate is written to
+                    replay_{i}.txt, with its roadnet in replay_roadnet_{i}.json.
+        compress:   Whether to gzip the replay files, as they are written
+
+        Returns
+        -------
+        The rows of results which were replayed, best first, with the paths of their replay files in "replay" and
+        "replay_roadnet" columns.
+        """
+        name = self._metric_name(metric)
+        name = name[0] if isinstance(name, list) else name
+
+        best = results.sort_values(name, kind="stable").head(n).copy()
+        sim = self._simulator(metric)
+        os.makedirs(directory, exist_ok=True)
+
+        suffix = ".gz" if compress else ""
+        replays, roadnets = [], []
+        for i, x in enumerate(df_to_x(best, self._time_period)):
+            replays.append(os.path.join(directory, f"replay_{i}.txt{suffix}"))
+            roadnets.append(os.path.join(directory, f"replay_roadnet_{i}.json{suffix}"))
+            sim.replay(x, replays[-1], roadnets[-1], compress=compress)
+
+        best["replay"] = replays
+        best["replay_roadnet"] = roadnets
+        return best
+
+    @staticmethod
+    def _metric_name(metric):
+        """Results column name(s) for a metric class, or list of metric classes"""
+        if isinstance(metric, (list, tuple)):
+            return [m().name for m in metric]
+        return metric().name
+
+    def _simulator(self, metric) -> Simulator:
+        return Simulator(self._g, metric, self._strategy, self._time_period, self._sim_iterations,
+                         persistent_engine=self._persistent_engine, warmup=self._warmup,
+                         steady_state=self._steady_state, engine_factory=self._engine_factory,
+                         profile=self.profiler is not None)
+
+    def _grid(self, interval: Tuple[float, float], steps_per_axis: int) -> np.ndarray:
+        """Returns all grid points as rows, in the same order as scipy.optimize.brute would evaluate them"""
+        grid = Grid(interval, steps_per_axis, self._num_params)
+        return grid.points(np.arange(len(grid)))
+
+    def _evaluate_batch(self, sim: Simulator, x: np.ndarray, steps: Optional[int] = None) -> np.ndarray:
+        """
+        Parameters
+        ----------
+        sim:    Simulator to evaluate candidates with
+        x:      2D array where each row is a set of traffic light phase timings
+        steps:  Optional number of steps to simulate each candidate for, overriding the simulator's
+
+        Returns
+        -------
+        2D array of results, one row per candidate, in the same order as x. Candidates found in the cache are not
+        simulated again.
+        """
+        results, _ = self._run_batch(sim, x, steps)
+        return results
+
+    def _evaluate_contributions(self, sim: Simulator, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        As _run_batch, but also returns the contribution of each intersection to each candidate's result, as a
+        (candidates, intersections) array (see SimulationResult.contributions), between the results and steps used
+        """
+        results, steps_used = self._run_batch(sim, x, contributions=True)
+        return results[:, :len(sim.metrics)], results[:, len(sim.metrics):], steps_used
+
+    def _run_batch(self, sim: Union[Simulator, QueueSimulator], x: np.ndarray, steps: Optional[int] = None,
+                   contributions: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        As _evaluate_batch, but also returns the number of steps each candidate's simulation used. If contributions is
+        set, each row of results is followed by its intersections' contributions.
+        """
+        if self.cache is None:
+            results = self._simulate_batch(sim, x, steps, contributions)
+        else:
+            keys = [sim.cache_key(row, steps) for row in x]
+            if contributions:
+                keys = [stable_hash(key, "contributions") for key in keys]
+            cached = {key: self.cache.get(key) for key in dict.fromkeys(keys)}
+
+            missing = [key for key, result in cached.items() if result is None]
+            if missing:
+                rows = {}
+                for key, row in zip(keys, x):
+                    rows.setdefault(key, row)
+                for key, result in zip(missing, self._simulate_batch(sim, np.array([rows[key] for key in missing]),
+                                                                     steps, contributions)):
+                    self.cache.put(key, result)
+                    cached[key] = result
+
+            # Repeated candidates within the batch are only simulated once
+            self.cache.hits += len(keys) - len(cached)
+
+            results = np.vstack([cached[key] for key in keys])
+
+        return results[:, :-1], results[:, -1].astype(int)
+
+    def _simulate_batch(self, sim: Union[Simulator, QueueSimulator], x: np.ndarray, steps: Optional[int] = None,
+                        contributions: bool = False) -> np.ndarray:
+        """
+        Simulates each row of x, returning a 2D array of results in the same order, where the last column is the number
+        of steps used. If contributions is set, the intersections' contributions are inserted before it.
+        """
+        if isinstance(sim, QueueSimulator):
+            # The queue model simulates a whole batch at once, faster than any pool of processes
+            results = sim.simulate_batch(x, steps)
+        elif self._workers <= 1:
+            results = [sim.simulate(row, steps) for row in x]
+        else:
+            with self._worker_pool(sim) as pool:
+                results = list(pool.map(_simulate_in_worker, x, repeat(steps)))
+
+        if self.profiler is not None:
+            for result in results:
+                if result.profile is not None:
+                    self.profiler.add(result.profile)
+
+        if contributions:
+            if any(result.contributions is None for result in results):
+                raise ValueError("None of the simulator's metrics report their contributions by lane")
+            return np.vstack([np.concatenate([result.values, result.contributions, [result.steps]])
+                              for result in results])
+        return np.vstack([np.append(result.values, result.steps) for result in results])
 
-        x_min, f_min, grid, results = scipy.optimize.brute(func=sim.evaluate,
-                                                           ranges=(interval,) * self._num_params,
-                                                           Ns=steps_per_axis,
-                                                           full_output=True,
-                                                           finish=None)
+    def _record_steps(self, df: pandas.DataFrame, steps_used: np.ndarray) -> pandas.DataFrame:
+        """Adds the steps each evaluation used to df, if simulations may have been ended early"""
+        if self._steady_state is not None:
+            df["steps_used"] = steps_used
+        return df
 
-        results = results.flatten()
-        grid = np.moveaxis(grid, 0, self._num_params).reshape(-1, self._num_params)
+    @contextmanager
+    def _worker_pool(self, sim: Simulator):
+        """
+        Provides a process pool of simulators for the duration of an optimisation, so that workers (and any persistent
+        engines they hold) are reused between batches. Nested uses for the same simulator share the outermost pool.
+        """
+        if self._workers <= 1 or (self._pool is not None and self._pool[0] is sim):
+            yield None if self._pool is None else self._pool[1]
+            return
 
-        return results_to_df(grid, results, metric().name, self._time_period)
+        # A pool nested in another simulator's replaces it until the nested block exits, when the outer pool is restored
+        outer = self._pool
+        with ProcessPoolExecutor(max_workers=self._workers, initializer=_init_worker, initargs=(sim,)) as pool:
+            self._pool = (sim, pool)
+            try:
+                yield pool
+            finally:
+                self._pool = outer
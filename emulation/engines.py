@@ -0,0 +1,71 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List
+
+try:
+    import cityflow as cf
+except ImportError:
+    # Simulations can still be run on other engines, e.g. for benchmarking
+    cf = None
+
+
+class Engine(ABC):
+    """
+    Interface of the traffic simulation engines a Simulator can run on - the parts of CityFlow's Engine used by the
+    simulator and metrics. CityFlow's Engine is registered as a virtual subclass. Other engines are created the same
+    way, from the path of a CityFlow config file and a thread count, and read the same roadnet and flow files.
+    """
+
+    @abstractmethod
+    def next_step(self) -> None:
+        pass
+
+    @abstractmethod
+    def reset(self, seed: bool = False) -> None:
+        pass
+
+    @abstractmethod
+    def set_tl_phase(self, intersection_id: str, phase_id: int) -> None:
+        pass
+
+    @abstractmethod
+    def get_vehicles(self, include_waiting: bool = False) -> List[str]:
+        pass
+
+    @abstractmethod
+    def get_vehicle_count(self) -> int:
+        pass
+
+    @abstractmethod
+    def get_vehicle_speed(self) -> Dict[str, float]:
+        pass
+
+    @abstractmethod
+    def get_lane_vehicle_count(self) -> Dict[str, int]:
+        pass
+
+    @abstractmethod
+    def get_lane_waiting_vehicle_count(self) -> Dict[str, int]:
+        pass
+
+    @abstractmethod
+    def get_current_time(self) -> float:
+        pass
+
+    @abstractmethod
+    def snapshot(self):
+        pass
+
+    @abstractmethod
+    def load(self, archive) -> None:
+        pass
+
+
+if cf is not None:
+    Engine.register(cf.Engine)
+
+
+def cityflow_engine(config_file: str, thread_num: int = 1) -> Engine:
+    """Creates a CityFlow engine - the default engine of a Simulator"""
+    if cf is None:
+        raise ImportError("CityFlow is not installed - install it, or give the simulator an engine_factory")
+    return cf.Engine(config_file, thread_num=thread_num)
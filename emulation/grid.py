@@ -0,0 +1,93 @@
+import os
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import pandas
+
+from simulation_builder.serialization import atomic_write
+
+
+class Grid:
+    """
+    Grid of every combination of num_params parameters, each taking steps_per_axis evenly spaced values from the same
+    interval - in the order scipy.optimize.brute would evaluate them, with the last parameter varying fastest.
+
+    Points are generated on demand from their index in the grid, so a grid is never held in memory as a whole, and can
+    be split into contiguous shards to be searched on separate machines.
+    """
+
+    def __init__(self, interval: Tuple[float, float], steps_per_axis: int, num_params: int):
+        self.values = np.mgrid[slice(*interval, complex(steps_per_axis))]
+        self.num_params = num_params
+        self.shape = (steps_per_axis,) * num_params
+
+    def __len__(self) -> int:
+        return len(self.values) ** self.num_params
+
+    def points(self, indices: np.ndarray) -> np.ndarray:
+        """The points at the given indices, as rows"""
+        return self.values[np.stack(np.unravel_index(indices, self.shape), axis=1)].reshape(len(indices),
+                                                                                            self.num_params)
+
+    def shard(self, shard_index: int, num_shards: int) -> range:
+        """Indices of the points in a shard - shards are contiguous, and in order cover the whole grid"""
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"Shard {shard_index} does not exist in {num_shards} shards")
+        return range(len(self) * shard_index // num_shards, len(self) * (shard_index + 1) // num_shards)
+
+    def chunks(self, indices: range, chunk_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yields (indices, points) for each successive chunk of chunk_size points of indices"""
+        for start in range(indices.start, indices.stop, chunk_size):
+            chunk = np.arange(start, min(start + chunk_size, indices.stop))
+            yield chunk, self.points(chunk)
+
+
+def read_results(path: str) -> Optional[pandas.DataFrame]:
+    """
+    Reads a results file written by append_results, indexed by grid point, or returns None if it doesn't exist. A row
+    left incomplete by a crash while it was being written is removed from the file.
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb+') as f:
+        contents = f.read()
+        if contents and not contents.endswith(b"\n"):
+            f.truncate(contents.rfind(b"\n") + 1)
+    if os.path.getsize(path) == 0:
+        return None
+
+    return pandas.read_csv(path, index_col=0, float_precision="round_trip")
+
+
+def append_results(path: str, df: pandas.DataFrame) -> None:
+    """Appends the rows of df to a CSV results file, writing its header if the file is new, and syncs it to disk"""
+    header = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, 'a', newline='') as f:
+        df.to_csv(f, header=header)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def search_file(path: str) -> str:
+    """Path of the sidecar file recording which search wrote a results file"""
+    return f"{path}.search"
+
+
+def claim_results(path: str, fingerprint: str) -> None:
+    """
+    Records that the results file at path belongs to the search with the given fingerprint, or raises a ValueError if
+    it already holds results from another search (or from a search which wasn't recorded)
+    """
+    sidecar = search_file(path)
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        recorded = None
+        if os.path.exists(sidecar):
+            with open(sidecar, 'r') as f:
+                recorded = f.read().strip()
+        if recorded != fingerprint:
+            raise ValueError(f"{path} holds the results of a different grid search")
+        return
+
+    with atomic_write(sidecar) as f:
+        f.write(fingerprint.encode())
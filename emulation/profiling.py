@@ -0,0 +1,207 @@
+import csv
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Dict, Iterator, List, Optional
+
+import pandas
+
+from simulation_builder.serialization import atomic_write
+
+# Upper bounds (in seconds) of the buckets of the per-step latency histograms
+STEP_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 1e-1, 2.5e-1, 1.0)
+
+
+class EvaluationProfile:
+    """
+    Where the time of a single evaluation went: the wall and CPU time of each of its stages (e.g. roadnet generation,
+    engine construction, engine steps and metric updates), a histogram of the latency of each engine step, and the
+    number of vehicles in the engine over time.
+    """
+
+    def __init__(self, vehicle_sample_every: int = 10):
+        """
+        Parameters
+        ----------
+        vehicle_sample_every:   Number of steps between samples of the engine's vehicle count
+        """
+        self.vehicle_sample_every = vehicle_sample_every
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.steps = 0
+
+        self.wall: Dict[str, float] = {}
+        self.cpu: Dict[str, float] = {}
+        self.step_counts = [0] * (len(STEP_BUCKETS) + 1)
+        self.step_sum = 0.0
+        # (step, vehicle count) samples
+        self.vehicle_counts: List[List[int]] = []
+
+        self._start = (time.perf_counter(), time.process_time())
+        self._lap = self._start
+
+    def _add(self, stage: str, wall: float, cpu: float) -> None:
+        self.wall[stage] = self.wall.get(stage, 0.0) + wall
+        self.cpu[stage] = self.cpu.get(stage, 0.0) + cpu
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Adds the time spent in the block to the named stage"""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self._add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def lap(self, stage: Optional[str] = None) -> float:
+        """
+        Adds the time since the previous lap to the named stage (or discards it, if no stage is given), returning the
+        wall time. Cheaper than stage, for timing each part of the step loop.
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        elapsed = wall - self._lap[0]
+        if stage is not None:
+            self._add(stage, elapsed, cpu - self._lap[1])
+        self._lap = (wall, cpu)
+        return elapsed
+
+    def record_step(self, seconds: float) -> None:
+        """Adds the latency of an engine step to the histogram"""
+        self.step_counts[bisect_left(STEP_BUCKETS, seconds)] += 1
+        self.step_sum += seconds
+
+    def record_vehicles(self, step: int, count: int) -> None:
+        self.vehicle_counts.append([step, count])
+
+    def finish(self, steps: int) -> None:
+        """Records the total time of the evaluation, which simulated the given number of steps"""
+        self.steps = steps
+        self._add("total", time.perf_counter() - self._start[0], time.process_time() - self._start[1])
+
+    def to_dict(self) -> Dict:
+        return {
+            "pid": self.pid,
+            "started": self.started,
+            "steps": self.steps,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "step_histogram": {"buckets": list(STEP_BUCKETS), "counts": self.step_counts, "sum": self.step_sum},
+            "vehicle_counts": self.vehicle_counts
+        }
+
+
+def stage(profile: Optional[EvaluationProfile], name: str) -> ContextManager:
+    """profile.stage(name), or a no-op if profiling is disabled"""
+    return _DISABLED if profile is None else profile.stage(name)
+
+
+_DISABLED = nullcontext()
+
+
+class Profiler:
+    """
+    Collects the profiles of every evaluation of an optimisation run, and rolls them up into per-stage totals and a
+    combined step latency histogram. Profiles can be streamed to a JSON lines trace as they arrive, or exported once the
+    run is over as CSV, JSON lines or a Prometheus text file.
+    """
+
+    def __init__(self, trace_file: Optional[str] = None):
+        """
+        Parameters
+        ----------
+        trace_file: Optional JSON lines file to append each evaluation's profile to, as soon as it is collected
+        """
+        self.trace_file = trace_file
+        self.profiles: List[EvaluationProfile] = []
+
+    def add(self, profile: EvaluationProfile) -> None:
+        self.profiles.append(profile)
+        if self.trace_file is not None:
+            with open(self.trace_file, 'a') as f:
+                f.write(json.dumps(dict(profile.to_dict(), evaluation=len(self.profiles) - 1)) + "\n")
+
+    def __len__(self) -> int:
+        return len(self.profiles)
+
+    def stages(self) -> List[str]:
+        """Names of every stage recorded, in the order they first appeared"""
+        return list(dict.fromkeys(name for profile in self.profiles for name in profile.wall))
+
+    def summary(self) -> pandas.DataFrame:
+        """
+        Returns a dataframe with a row per stage, giving its total wall and CPU time across all evaluations, its mean
+        wall time per evaluation, and its share of the total wall time.
+        """
+        stages = self.stages()
+        wall = [sum(profile.wall.get(name, 0.0) for profile in self.profiles) for name in stages]
+        cpu = [sum(profile.cpu.get(name, 0.0) for profile in self.profiles) for name in stages]
+        total = sum(profile.wall.get("total", 0.0) for profile in self.profiles)
+
+        df = pandas.DataFrame({"wall": wall, "cpu": cpu}, index=pandas.Index(stages, name="stage"))
+        df["wall_per_evaluation"] = df["wall"] / max(len(self.profiles), 1)
+        df["share"] = df["wall"] / total if total > 0 else 0.0
+        return df
+
+    def step_histogram(self) -> List[int]:
+        """Combined step latency histogram of every evaluation, with a count per bucket of STEP_BUCKETS plus overflow"""
+        return [sum(counts) for counts in zip(*(profile.step_counts for profile in self.profiles))] or \
+            [0] * (len(STEP_BUCKETS) + 1)
+
+    def write_jsonl(self, path: str) -> None:
+        """Writes each evaluation's profile as a line of JSON"""
+        with atomic_write(path) as f:
+            for i, profile in enumerate(self.profiles):
+                f.write((json.dumps(dict(profile.to_dict(), evaluation=i)) + "\n").encode())
+
+    def write_csv(self, path: str) -> None:
+        """
+        Writes a row per evaluation, with the wall and CPU time of each stage, the number of steps and their mean
+        latency, and the largest vehicle count sampled.
+        """
+        stages = self.stages()
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["evaluation", "pid", "started", "steps", "mean_step", "max_vehicles"] +
+                            [f"{name}_{clock}" for name in stages for clock in ("wall", "cpu")])
+            for i, profile in enumerate(self.profiles):
+                num_steps = sum(profile.step_counts)
+                writer.writerow([i, profile.pid, profile.started, profile.steps,
+                                 profile.step_sum / num_steps if num_steps > 0 else "",
+                                 max((count for _, count in profile.vehicle_counts), default="")] +
+                                [getattr(profile, clock).get(name, 0.0) for name in stages for clock in ("wall", "cpu")])
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Writes the roll-up of every evaluation in Prometheus' text exposition format, e.g. for node_exporter's textfile
+        collector. The file is replaced atomically, so it is never scraped half written.
+        """
+        lines = ["# HELP flowrence_evaluations_total Number of evaluations profiled",
+                 "# TYPE flowrence_evaluations_total counter",
+                 f"flowrence_evaluations_total {len(self.profiles)}"]
+
+        summary = self.summary()
+        for clock, description in (("wall", "Wall"), ("cpu", "CPU")):
+            metric = f"flowrence_stage_{clock}_seconds_total"
+            lines += [f"# HELP {metric} {description} time spent in each stage of evaluation",
+                      f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{stage="{name}"}} {seconds!r}' for name, seconds in summary[clock].items()]
+
+        lines += ["# HELP flowrence_step_seconds Latency of each engine step",
+                  "# TYPE flowrence_step_seconds histogram"]
+        counts = self.step_histogram()
+        cumulative = 0
+        for bound, count in zip(STEP_BUCKETS + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f'flowrence_step_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines += [f"flowrence_step_seconds_sum {sum(profile.step_sum for profile in self.profiles)!r}",
+                  f"flowrence_step_seconds_count {cumulative}"]
+
+        lines += ["# HELP flowrence_vehicles_max Largest number of vehicles sampled in any evaluation",
+                  "# TYPE flowrence_vehicles_max gauge",
+                  f"flowrence_vehicles_max "
+                  f"{max((count for p in self.profiles for _, count in p.vehicle_counts), default=0)}"]
+
+        with atomic_write(path) as f:
+            f.write(("\n".join(lines) + "\n").encode())
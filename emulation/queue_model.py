@@ -0,0 +1,348 @@
+import functools
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from emulation.cache import stable_hash
+from emulation.simulator import SimulationResult
+from metrics.metrics import CompletedJourneysMetric, WaitTimeMetric
+from simulation_builder.compact import CompactGraph
+from simulation_builder.flows import FlowStrategy, graph_to_flow
+from simulation_builder.graph import Graph
+from simulation_builder.roadnets import RoadnetTemplate
+
+
+class QueueSimulator:
+    """
+    Fast, approximate alternative to Simulator, for screening or ranking many candidate timings before simulating a
+    shortlist of them with CityFlow.
+
+    The same roadnet and flows as Simulator's are run through a mesoscopic queue model, in which traffic is a fluid
+    rather than individual vehicles. Vehicles travel along each road of their route in its free-flow time, then queue at
+    its end for the road link onto their next road. Each road link discharges its queue at the saturation flow while it
+    is in its intersection's current light phase, sharing the room left on the next road with the other road links into
+    it. Vehicles enter the roadnet at up to one per road per step, while their first road has room.
+
+    Every candidate in a batch is simulated at once, with the state of all of them kept in arrays, so the cost of a
+    step barely grows with the number of candidates. Having no individual vehicles, the model can't update Metric
+    classes - instead it computes the aggregates of the metrics it supports directly, from the numbers of vehicles
+    spawned, moving, queued and completed.
+    """
+
+    # Metrics the model can calculate
+    METRICS = (CompletedJourneysMetric, WaitTimeMetric)
+
+    def __init__(self, g: Graph, metric, strategy=None, timing_period: Optional[int] = None, steps=1000,
+                 config_file: str = "cityflow_config/config.json", warmup: int = 0, saturation_flow: float = 0.5):
+        """
+        Parameters
+        ----------
+        g:                  Graph of roadnet to run simulation on
+        metric:             Metric class (one of METRICS) to calculate, or a list of them. Metrics configured with
+                            functools.partial are accepted, but their options are ignored.
+        strategy:           Flow strategy for the simulation - defaults to uniform flow
+        timing_period:      Optional fixed duration for a full traffic light cycle, as for Simulator
+        steps:              Number of steps to run the simulation for
+        config_file:        Base CityFlow config, giving the duration of each step
+        warmup:             Number of the simulation's steps to run under the default traffic light timings, before the
+                            candidate timings take over, as for Simulator
+        saturation_flow:    Vehicles per second each road link discharges while green
+        """
+        self.g = CompactGraph.from_graph(g)
+        self.metric = metric
+        self.metrics = list(metric) if isinstance(metric, (list, tuple)) else [metric]
+        for m in self.metrics:
+            if self._metric_class(m) not in self.METRICS:
+                raise ValueError(f"The queue model can't calculate {m} - it supports "
+                                 f"{', '.join(cls.__name__ for cls in self.METRICS)}")
+
+        self.strategy = FlowStrategy() if strategy is None else strategy
+        self.timing_period = timing_period
+        self.steps = steps
+        if warmup >= steps:
+            raise ValueError(f"Warm-up of {warmup} steps leaves no steps to collect metrics over")
+        self.warmup = warmup
+        self.saturation_flow = saturation_flow
+
+        self.intersections = sorted(self.g.vertices[i] for i in self.g.intersections)
+
+        with open(config_file, 'r') as f:
+            self._interval = json.loads(f.read())["interval"]
+
+        # The same roadnet (and intersection widths) as Simulator's
+        self._roadnet_template = RoadnetTemplate(self.g, intersection_width=50, lane_width=8)
+        self._build(self._roadnet_template.render(), graph_to_flow(self.g, self.strategy))
+
+    @staticmethod
+    def _metric_class(metric):
+        return metric.func if isinstance(metric, functools.partial) else metric
+
+    def _build(self, roadnet: Dict, flows: List[Dict]) -> None:
+        """Converts the roadnet and flows into the arrays the model is run on"""
+        roads = roadnet["roads"]
+        road_index = {road["id"]: i for i, road in enumerate(roads)}
+        length = np.array([np.hypot(road["points"][-1]["x"] - road["points"][0]["x"],
+                                    road["points"][-1]["y"] - road["points"][0]["y"]) for road in roads])
+        road_speed = np.array([min(lane["maxSpeed"] for lane in road["lanes"]) for road in roads])
+        lanes = np.array([len(road["lanes"]) for road in roads])
+
+        # Road links of every (non-virtual) intersection, and the links available in each of its light phases
+        self._light_ids = []
+        link_index, link_light, link_end, available = {}, [], [], []
+        for intersection in roadnet["intersections"]:
+            if intersection["virtual"]:
+                continue
+            phases = intersection["trafficLight"]["lightphases"]
+            for k, link in enumerate(intersection["roadLinks"]):
+                link_index[(road_index[link["startRoad"]], road_index[link["endRoad"]])] = len(link_light)
+                link_light.append(len(self._light_ids))
+                link_end.append(road_index[link["endRoad"]])
+                available.append([k in phase["availableRoadLinks"] for phase in phases])
+            self._light_ids.append(intersection["id"])
+
+        self._max_phases = max((len(a) for a in available), default=1)
+        self._link_light = np.array(link_light, dtype=np.int64)
+        self._link_end = np.array(link_end, dtype=np.int64)
+        self._link_available = np.array([a + [False] * (self._max_phases - len(a)) for a in available],
+                                        dtype=bool).reshape(len(link_light), self._max_phases)
+
+        # Traffic is tracked per cohort - the vehicles of one flow on one leg of its route. The cohorts of each flow
+        # are numbered consecutively, so a flow's next cohort is the next number.
+        cohort_road, cohort_link, cohort_travel, first_cohort = [], [], [], []
+        spacing = np.full(len(roads), 0.0)
+        for flow in flows:
+            route = [road_index[road] for road in flow["route"]]
+            speed = np.minimum(flow["vehicle"]["maxSpeed"], road_speed[route])
+            first_cohort.append(len(cohort_road))
+            cohort_road += route
+            cohort_link += [link_index[(start, end)] for start, end in zip(route[:-1], route[1:])] + [-1]
+            cohort_travel += (length[route] / speed).tolist()
+            spacing[route] = np.maximum(spacing[route], flow["vehicle"]["length"] + flow["vehicle"]["minGap"])
+        spacing[spacing == 0] = 7.5
+
+        self._cohort_road = np.array(cohort_road, dtype=np.int64)
+        self._cohort_link = np.array(cohort_link, dtype=np.int64)
+        # Steps to travel the length of each cohort's road
+        self._cohort_steps = np.maximum(np.round(np.array(cohort_travel) / self._interval), 1).astype(np.int64)
+        self._first_cohort = np.array(first_cohort, dtype=np.int64)
+        self._first_road = self._cohort_road[self._first_cohort]
+        self._road_storage = np.maximum(np.floor(length / spacing) * lanes, 1.0)
+
+        # Cohorts whose road ends their route, and those which turn onto another road
+        self._last_cohorts = np.flatnonzero(self._cohort_link < 0)
+        self._turning_cohorts = np.flatnonzero(self._cohort_link >= 0)
+
+        # Sparse matrices summing the rows of cohorts (or road links, or flows) into rows of road links (or roads)
+        self._cohort_links = _grouping(self._cohort_link[self._turning_cohorts], len(link_light))
+        self._cohort_roads = _grouping(self._cohort_road, len(roads))
+        self._link_roads = _grouping(self._link_end, len(roads))
+        self._flow_roads = _grouping(self._first_road, len(roads))
+
+        self._flow_start = np.array([flow.get("startTime", 0) for flow in flows], dtype=float)
+        self._flow_end = np.array([flow.get("endTime", -1) for flow in flows], dtype=float)
+        self._flow_end[self._flow_end < 0] = np.inf
+        self._flow_interval = np.array([flow["interval"] for flow in flows], dtype=float)
+
+    def _traffic_light_phases(self, x) -> Dict:
+        """Maps each intersection to its list of phase timings, taken from the 1D array of timings x, as Simulator"""
+        if not self.intersections:
+            return {}
+        x = np.array(np.array_split(np.asarray(x, dtype=float).flatten(), len(self.intersections)))
+        if self.timing_period is not None:
+            x3 = self.timing_period - x.sum(axis=1)
+            x = np.insert(x, x.shape[1] - 1, x3, axis=1)
+        return {intersection: timing for (intersection, timing) in zip(self.intersections, x.tolist())}
+
+    def _durations(self, x: Optional[np.ndarray]) -> np.ndarray:
+        """
+        Light phase durations of each intersection, as an array of (candidates, intersections, phases), for each row of
+        timings x (or the default timings, if x is None). Missing phases have zero duration.
+        """
+        schedules = [self._roadnet_template.light_schedule(None)] if x is None else \
+            [self._roadnet_template.light_schedule(self._traffic_light_phases(row)) for row in x]
+
+        durations = np.zeros((len(schedules), len(self._light_ids), self._max_phases))
+        for b, schedule in enumerate(schedules):
+            for i, id in enumerate(self._light_ids):
+                durations[b, i, :len(schedule[id])] = schedule[id]
+        if np.any(durations.sum(axis=2) <= 0):
+            raise ValueError("Every traffic light cycle must have a positive total duration")
+        return durations
+
+    def cache_key(self, x, steps: Optional[int] = None) -> str:
+        """As Simulator.cache_key - results of the queue model never share keys with Simulator's"""
+        timings = np.round(np.asarray(x, dtype=float).flatten() / self._interval).astype(int).tolist()
+        return stable_hash("queue", self.g.adjacency_list, self.strategy, [self._metric_class(m) for m in self.metrics],
+                           self.timing_period, self.steps if steps is None else steps, self.warmup,
+                           self.saturation_flow, timings)
+
+    def evaluate(self, x, steps: Optional[int] = None):
+        """As Simulator.evaluate"""
+        return self.simulate(x, steps).values[np.newaxis]
+
+    def simulate(self, x, steps: Optional[int] = None) -> SimulationResult:
+        """As Simulator.simulate"""
+        return self.simulate_batch(np.asarray(x, dtype=float)[np.newaxis], steps)[0]
+
+    def simulate_batch(self, x: np.ndarray, steps: Optional[int] = None) -> List[SimulationResult]:
+        """
+        Parameters
+        ----------
+        x:      2D array where each row is a set of traffic light phase timings
+        steps:  Optional number of steps to run the simulation for, overriding the simulator's
+
+        Returns
+        -------
+        The result of simulating each row of x, in order - all rows are simulated together.
+        """
+        steps = self.steps if steps is None else steps
+        if steps <= self.warmup:
+            raise ValueError(f"Warm-up of {self.warmup} steps leaves no steps to collect metrics over")
+
+        x = np.asarray(x, dtype=float).reshape(len(x), -1)
+        candidates = self._durations(x)
+        defaults = np.broadcast_to(self._durations(None), candidates.shape)
+
+        state = _QueueState(self, len(x))
+        state.start_lights(defaults if self.warmup > 0 else candidates)
+        for step in range(steps):
+            if step == self.warmup and self.warmup > 0:
+                # The candidate timings take over from the start of their first phase, and metrics are only
+                # collected from here
+                state.start_lights(candidates)
+                state.reset_totals()
+            state.step(step)
+
+        values = np.column_stack([state.aggregate(self._metric_class(m)) for m in self.metrics])
+        return [SimulationResult(row, steps) for row in values]
+
+
+class _QueueState:
+    """
+    State of a QueueSimulator's model, for a batch of candidates. Arrays have a row per cohort (or flow, road link,
+    road or light) and a column per candidate.
+    """
+
+    def __init__(self, model: QueueSimulator, batch: int):
+        self._model = model
+        self._time = 0.0
+
+        cohorts = len(model._cohort_road)
+        self._ring = int(model._cohort_steps.max(initial=1)) + 1
+        # Vehicles travelling along each cohort's road, by the step (modulo the ring's length) they reach its end
+        self._travelling = np.zeros((self._ring, cohorts, batch))
+        self._in_transit = np.zeros((cohorts, batch))
+        self._queued = np.zeros((cohorts, batch))
+        # Vehicles waiting to enter the roadnet, per flow
+        self._waiting = np.zeros((len(model._first_cohort), batch))
+
+        self._phase = np.zeros((len(model._light_ids), batch), dtype=np.int64)
+        self._remaining = np.zeros((len(model._light_ids), batch))
+        self._durations = None
+
+        self.reset_totals()
+
+    def reset_totals(self) -> None:
+        batch = self._queued.shape[1]
+        self.completed = np.zeros(batch)
+        # Running totals, over every step, of the vehicles in the roadnet and of the vehicles stopped, both including
+        # those waiting to enter it - as WaitTimeMetric counts them
+        self.vehicle_steps = np.zeros(batch)
+        self.stopped_steps = np.zeros(batch)
+        # Vehicles already in the roadnet count towards the journeys of the metrics' period
+        self.spawned = self._waiting.sum(axis=0) + self._queued.sum(axis=0) + self._in_transit.sum(axis=0)
+
+    def start_lights(self, durations: np.ndarray) -> None:
+        """Sets every light to its first phase, with the given (candidates, intersections, phases) durations"""
+        self._durations = durations.transpose(1, 2, 0)
+        self._phase[:] = 0
+        self._remaining[:] = self._durations[:, 0]
+
+    def _spawned_by(self, time: float) -> np.ndarray:
+        """Number of vehicles each flow has spawned by the start of a step at the given time"""
+        model = self._model
+        last = np.minimum(time, model._flow_end)
+        return np.where(last >= model._flow_start,
+                        np.floor((last - model._flow_start) / model._flow_interval) + 1, 0)
+
+    def _travel(self, step: int, cohorts: np.ndarray, vehicles: np.ndarray) -> None:
+        """Starts vehicles travelling along the roads of the given cohorts"""
+        self._travelling[(step + self._model._cohort_steps[cohorts]) % self._ring, cohorts] += vehicles
+        self._in_transit[cohorts] += vehicles
+
+    def step(self, step: int) -> None:
+        model = self._model
+
+        # Vehicles due to be spawned by the start of the step queue to enter the roadnet
+        spawned = self._spawned_by(self._time) - self._spawned_by(self._time - model._interval)
+        self._waiting += spawned[:, np.newaxis]
+        self.spawned += spawned.sum()
+
+        # Vehicles reaching the end of their road this step join its queue, or leave the roadnet if it ends their route
+        slot = step % self._ring
+        self._queued += self._travelling[slot]
+        self._in_transit -= self._travelling[slot]
+        self._travelling[slot] = 0
+        self.completed += self._queued[model._last_cohorts].sum(axis=0)
+        self._queued[model._last_cohorts] = 0
+
+        # Road links discharge their queues while green, limited by the room on the road they lead to
+        turning = model._turning_cohorts
+        queued = self._queued[turning]
+        demand = model._cohort_links @ queued
+        green = model._link_available[np.arange(len(model._link_light))[:, np.newaxis], self._phase[model._link_light]]
+        discharge = np.minimum(demand, green * (model.saturation_flow * model._interval))
+
+        room = np.maximum(model._road_storage[:, np.newaxis] - model._cohort_roads @ (self._queued + self._in_transit),
+                          0.0)
+        inflow = model._link_roads @ discharge
+        discharge *= np.minimum(1.0, _ratio(room, inflow))[model._link_end]
+
+        moving = queued * _ratio(discharge, demand)[model._cohort_link[turning]]
+        self._queued[turning] -= moving
+        self._travel(step, turning + 1, moving)
+
+        # Waiting vehicles enter their first road, at up to one per road per step while it has room
+        room = np.maximum(room - model._link_roads @ discharge, 0.0)
+        entering_demand = model._flow_roads @ self._waiting
+        entry = np.minimum(np.minimum(room, 1.0), entering_demand)
+        entering = self._waiting * _ratio(entry, entering_demand)[model._first_road]
+        self._waiting -= entering
+        self._travel(step, model._first_cohort, entering)
+
+        stopped = self._waiting.sum(axis=0) + self._queued.sum(axis=0)
+        self.vehicle_steps += stopped + self._in_transit.sum(axis=0)
+        self.stopped_steps += stopped
+
+        self._advance_lights()
+        self._time += model._interval
+
+    def _advance_lights(self) -> None:
+        """Advances each light by a step, switching phase as PhaseSchedule (and CityFlow) do"""
+        self._remaining -= self._model._interval
+        while True:
+            lights, batch = np.nonzero(self._remaining <= 0)
+            if len(lights) == 0:
+                break
+            phases = (self._phase[lights, batch] + 1) % self._model._max_phases
+            self._phase[lights, batch] = phases
+            self._remaining[lights, batch] += self._durations[lights, phases, batch]
+
+    def aggregate(self, metric) -> np.ndarray:
+        """Aggregate of the given metric class for each candidate, as its report would give"""
+        if metric is CompletedJourneysMetric:
+            return 1 - _ratio(self.completed, self.spawned)
+        return _ratio(self.stopped_steps, self.vehicle_steps)
+
+
+def _grouping(groups: np.ndarray, num_groups: int) -> csr_matrix:
+    """Sparse (num_groups, len(groups)) matrix, which sums rows into the group given for each row"""
+    return csr_matrix((np.ones(len(groups)), (groups, np.arange(len(groups)))), shape=(num_groups, len(groups)))
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """numerator / denominator, or zero where the denominator is zero"""
+    return np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape),
+                     where=denominator > 0)
@@ -1,80 +1,348 @@
+import gzip
 import json
 import os
-import uuid
-from typing import Optional
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
 
 import numpy as np
-import cityflow as cf
 
+from emulation.artifacts import ArtifactCache
+from emulation.cache import stable_hash
+from emulation.convergence import SteadyStateDetector
+from emulation.engines import Engine, cityflow_engine
+from emulation.profiling import EvaluationProfile, stage
+from metrics.observation import Observation
+from simulation_builder.compact import CompactGraph
 from simulation_builder.flows import FlowStrategy, graph_to_flow
 from simulation_builder.graph import Graph
-from simulation_builder.roadnets import graph_to_roadnet
+from simulation_builder.roadnets import RoadnetTemplate
+
+
+class PhaseSchedule:
+    """
+    Fixed-time traffic light control, driven from Python rather than baked into the roadnet.
+
+    Replicates CityFlow's own traffic light logic, so that an engine created with rlTrafficLight enabled runs exactly as
+    if the phase durations had been written into its roadnet.
+    """
+
+    def __init__(self, durations: Dict[str, List[float]], interval: float = 1.0):
+        """
+        Parameters
+        ----------
+        durations:  Dictionary mapping each intersection id to the durations of its light phases
+        interval:   Duration of a single simulation step
+        """
+        self._intersections = list(durations.keys())
+        self._durations = list(durations.values())
+        self._interval = interval
+
+        self._phases = [0] * len(self._durations)
+        self._remaining = [phases[0] for phases in self._durations]
+
+    def start(self, eng) -> None:
+        """Sets every traffic light to its first phase"""
+        for intersection in self._intersections:
+            eng.set_tl_phase(intersection, 0)
+
+    def step(self, eng) -> None:
+        """Advances every traffic light by one simulation step, switching phase on the engine where necessary"""
+        for i, durations in enumerate(self._durations):
+            phase = self._phases[i]
+            self._remaining[i] -= self._interval
+            while self._remaining[i] <= 0:
+                phase = (phase + 1) % len(durations)
+                self._remaining[i] += durations[phase]
+
+            if phase != self._phases[i]:
+                self._phases[i] = phase
+                eng.set_tl_phase(self._intersections[i], phase)
+
+
+def _gzip_file(source: str, destination: str) -> None:
+    with open(source, 'rb') as src, gzip.open(destination, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+
+@dataclass
+class SimulationResult:
+    values: np.ndarray
+    steps: int
+    # Where the evaluation's time went, if the simulator is profiling
+    profile: Optional[EvaluationProfile] = None
+    # Breakdown of the first metric which reports lane contributions (e.g. LaneWaitingMetric) by the intersection each
+    # lane leads into, in the order of Simulator.intersections
+    contributions: Optional[np.ndarray] = None
 
 
 class Simulator:
-    def __init__(self, g: Graph, metric, strategy=None, timing_period: Optional[int] = None, steps=1000):
+    def __init__(self, g: Graph, metric, strategy=None, timing_period: Optional[int] = None, steps=1000,
+                 artifacts: Optional[ArtifactCache] = None, config_file: str = "cityflow_config/config.json",
+                 persistent_engine: bool = False, warmup: int = 0,
+                 steady_state: Optional[SteadyStateDetector] = None,
+                 engine_factory: Optional[Callable[..., Engine]] = None,
+                 profile: bool = False):
         """
         Parameters
         ----------
-        g:              Graph of roadnet to run simulation on
-        metric:         Metric class to be instantiated upon evaluation, and updated each iteration of the simulation
+        g:              Graph of roadnet to run simulation on. It is stored as a CompactGraph.
+        metric:         Metric class to be instantiated upon evaluation, and updated each iteration of the simulation. May
+                        also be a list of metric classes, which are all updated from the same simulation. Metrics can
+                        be configured with functools.partial, e.g. partial(WaitTimeMetric, update_every=10).
         strategy:       Flow strategy for the simulation - defaults to uniform flow
         timing_period:  Optional fixed duration for a full traffic light cycle. If specified, the timing of the fourth
                         traffic phase parameter will be inferred - if not, then total duration may vary.
         steps:          Number of steps to run the simulation for.
+        artifacts:      Cache to write generated roadnet, flow and config files to - defaults to a per-process cache
+                        under cityflow_config/cache.
+        config_file:    Base CityFlow config, which generated config files are derived from.
+        persistent_engine:  If set, a single engine is created per process and reset between evaluations, with the
+                            traffic light phases driven from Python. This avoids re-parsing the roadnet and flow files
+                            for each evaluation, but means the flows are only generated once.
+        warmup:         Number of the simulation's steps to spend filling the network with vehicles, under the default
+                        traffic light timings, before the candidate timings take over. The warm-up is simulated once
+                        per process and snapshotted, and metrics are only collected over the remaining steps. Requires
+                        persistent_engine.
+        steady_state:   Optional detector to end simulations early, once the metrics have converged. steps is then the
+                        maximum number of steps to simulate.
+        engine_factory: Optional callable creating an Engine from a config file path and thread_num, in place of
+                        CityFlow's - such as benchmarks.fake_engine.FakeEngine. It must be picklable to be used with
+                        multiple workers.
+        profile:        Whether to time each stage of every evaluation, and the latency of each step - the result of
+                        simulate then carries an EvaluationProfile. Profiling adds a few clock reads per step, and
+                        nothing when disabled.
         """
 
-        self.g = g
+        self.g = CompactGraph.from_graph(g)
         self.metric = metric
+        self.metrics = list(metric) if isinstance(metric, (list, tuple)) else [metric]
         self.strategy = FlowStrategy() if strategy is None else strategy
         self.timing_period = timing_period
         self.steps = steps
 
-        self.intersections = list(sorted([v for v in self.g if len(g[v]) > 2]))
+        self.intersections = sorted(self.g.vertices[i] for i in self.g.intersections)
+
+        # Everything but the light phase timings is the same for each evaluation, so is only generated once
+        self._roadnet_template = RoadnetTemplate(self.g, intersection_width=50, lane_width=8)
+        self._lane_intersections = None
+
+        self._artifacts = ArtifactCache() if artifacts is None else artifacts
+        with open(config_file, 'r') as f:
+            self._config = json.loads(f.read())
 
-        flow = graph_to_flow(self.g, self.strategy)
-        with open("cityflow_config/flows/auto_flow.json", 'w') as f:
-            f.write(json.dumps(flow, indent=4))
+        if warmup > 0 and not persistent_engine:
+            raise ValueError("Warm-up snapshots require a persistent engine")
+        if warmup >= steps:
+            raise ValueError(f"Warm-up of {warmup} steps leaves no steps to collect metrics over")
 
-    def evaluate(self, x):
+        self.persistent_engine = persistent_engine
+        self.warmup = warmup
+        self.steady_state = steady_state
+        self.engine_factory = engine_factory
+        self.profile = profile
+        self._engine = None
+        self._engine_pid = None
+        self._warmup_snapshot = None
+
+    def _traffic_light_phases(self, x):
+        """Maps each intersection to its list of phase timings, taken from the 1D array of timings x"""
+        if not self.intersections:
+            # e.g. a spiral, whose roads only meet in pairs, has no traffic lights to time
+            return {}
+        # Infer missing parameters if fixed timing period is specified
+        x = np.array(np.array_split(x.flatten(), len(self.intersections)))
+        if self.timing_period is not None:
+            x3 = self.timing_period - x.sum(axis=1)
+            x = np.insert(x, x.shape[1] - 1, x3, axis=1)
+
+        return {intersection: timing for (intersection, timing) in zip(self.intersections, x.tolist())}
+
+    def cache_key(self, x, steps: Optional[int] = None) -> str:
+        """
+        Returns a key identifying the result of evaluating x for the given number of steps (defaulting to the
+        simulator's) - two candidates share a key if they would be simulated on the same graph, flows, metric, number of
+        steps, seed and engine, with timings equal to the simulator's resolution.
+        """
+        resolution = self._config["interval"]
+        timings = np.round(np.asarray(x, dtype=float).flatten() / resolution).astype(int).tolist()
+
+        return stable_hash(self.g.adjacency_list, self.strategy, self.metrics, self.timing_period,
+                           self.steps if steps is None else steps, self.warmup, self.steady_state, self._config["seed"],
+                           self.engine_factory, timings)
+
+    def evaluate(self, x, steps: Optional[int] = None):
         """
         Parameters
         ----------
-        x: A 1D numpy array of traffic light phase timings
+        x:      A 1D numpy array of traffic light phase timings
+        steps:  Optional number of steps to run the simulation for, overriding the simulator's (e.g. for a cheaper,
+                lower fidelity evaluation).
 
         Returns
         -------
-        The resulting aggregate metric calculated after N simulation iterations, with traffic light timings x.
+        The resulting aggregate metric calculated after N simulation iterations, with traffic light timings x, as a
+        (1, number of metrics) array. If a warm-up is used, metrics are only calculated over the steps after it.
         """
+        return self.simulate(x, steps).values[np.newaxis]
 
-        # Infer missing parameters if fixed timing period is specified
-        x = np.array(np.array_split(x.flatten(), len(self.intersections)))
-        if self.timing_period is not None:
-            x3 = self.timing_period - x.sum(axis=1)
-            x = np.insert(x, x.shape[1] - 1, x3, axis=1)
+    def simulate(self, x, steps: Optional[int] = None) -> SimulationResult:
+        """
+        As evaluate, but also returns the number of steps the simulation actually ran to (including any warm-up), which
+        may be fewer than requested if it was ended early by the steady state detector.
+        """
+        steps = self.steps if steps is None else steps
+        if steps <= self.warmup:
+            raise ValueError(f"Warm-up of {self.warmup} steps leaves no steps to collect metrics over")
+
+        profile = EvaluationProfile() if self.profile else None
+        traffic_light_phases = self._traffic_light_phases(x)
+
+        if self.persistent_engine:
+            eng = self._get_persistent_engine(profile)
+            with stage(profile, "reset"):
+                if self._warmup_snapshot is not None:
+                    eng.load(self._warmup_snapshot)
+                else:
+                    eng.reset(seed=True)
+        else:
+            eng = self._create_engine(traffic_light_phases, profile)
+
+        result = self._run(eng, traffic_light_phases, steps, profile)
+        if profile is not None:
+            profile.finish(result.steps)
+            result.profile = profile
+        return result
+
+    def replay(self, x, replay_file: str, roadnet_file: str, steps: Optional[int] = None,
+               compress: bool = False) -> SimulationResult:
+        """
+        Re-simulates x on a fresh engine with CityFlow's replay enabled, for viewing in its frontend. Evaluations made
+        through evaluate and simulate never save replays.
+
+        Parameters
+        ----------
+        x:              A 1D numpy array of traffic light phase timings
+        replay_file:    Path to write the replay to
+        roadnet_file:   Path to write the replay's roadnet to
+        steps:          Optional number of steps to run the simulation for, overriding the simulator's
+        compress:       Whether to gzip the replay and roadnet files. The replay is compressed as it is streamed from
+                        the engine, so the uncompressed replay is never written to disk.
 
-        traffic_light_phases = {intersection: timing for (intersection, timing) in zip(self.intersections, x.tolist())}
-        roadnet = graph_to_roadnet(self.g, traffic_light_phases, intersection_width=50, lane_width=8)
+        Returns
+        -------
+        Result of the simulation, as returned by simulate.
+        """
+        steps = self.steps if steps is None else steps
+        if steps <= self.warmup:
+            raise ValueError(f"Warm-up of {self.warmup} steps leaves no steps to collect metrics over")
 
-        flow = graph_to_flow(self.g, self.strategy)
+        traffic_light_phases = self._traffic_light_phases(x)
 
-        with open("cityflow_config/roadnets/auto_roadnet.json", 'w') as f:
-            f.write(json.dumps(roadnet, indent=4))
+        if not compress:
+            return self._record(traffic_light_phases, steps, replay_file, roadnet_file)
 
-        with open("cityflow_config/flows/auto_flow.json", 'w') as f:
-            f.write(json.dumps(flow, indent=4))
+        scratch = tempfile.mkdtemp()
+        try:
+            # The engine writes its replay into a pipe, which is compressed on another thread as the replay is written
+            fifo = os.path.join(scratch, "replay.txt")
+            os.mkfifo(fifo)
+            compressor = threading.Thread(target=_gzip_file, args=(fifo, replay_file), daemon=True)
+            compressor.start()
 
-        eng = cf.Engine("cityflow_config/config.json", thread_num=1)
+            uncompressed_roadnet = os.path.join(scratch, "replay_roadnet.json")
+            try:
+                # The replay is only closed, ending the stream, once the engine is destroyed on returning
+                result = self._record(traffic_light_phases, steps, fifo, uncompressed_roadnet)
+            finally:
+                if compressor.is_alive():
+                    try:
+                        # Release the compressor if the engine never opened the pipe
+                        os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                    except OSError:
+                        pass
+                compressor.join()
 
-        metric = self.metric()
+            _gzip_file(uncompressed_roadnet, roadnet_file)
+            return result
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def _record(self, traffic_light_phases: Dict, steps: int, replay_file: str, roadnet_file: str) -> SimulationResult:
+        """Simulates the candidate from scratch on a new engine, which saves its replay to the given files"""
+        eng = self._create_engine(None if self.persistent_engine else traffic_light_phases,
+                                  saveReplay=True, replayLogFile=replay_file, roadnetLogFile=roadnet_file,
+                                  rlTrafficLight=self.persistent_engine)
+        self._warm_up(eng)
+        return self._run(eng, traffic_light_phases, steps)
+
+    def _run(self, eng, traffic_light_phases: Dict, steps: int,
+             profile: Optional[EvaluationProfile] = None) -> SimulationResult:
+        """
+        Simulates the steps after any warm-up on eng, which must already be set up with the candidate's timings. If a
+        profile is given, the time spent in each part of the step loop is added to it.
+        """
+        if self.persistent_engine:
+            schedule = PhaseSchedule(self._roadnet_template.light_schedule(traffic_light_phases),
+                                     self._config["interval"])
+            schedule.start(eng)
+        else:
+            schedule = None
 
-        for _ in range(self.steps):
+        metrics = [metric() for metric in self.metrics]
+        observation = Observation(eng)
+
+        estimates = []
+        if profile is not None:
+            profile.lap()
+        for step in range(steps - self.warmup):
             eng.next_step()
-            metric.update(eng)
+            if profile is not None:
+                profile.record_step(profile.lap("step"))
+            if schedule is not None:
+                schedule.step(eng)
+                if profile is not None:
+                    profile.lap("lights")
+            observation.refresh()
+            for metric in metrics:
+                if step % getattr(metric, "update_every", 1) == 0:
+                    metric.update(observation)
+            if profile is not None:
+                if step % profile.vehicle_sample_every == 0:
+                    profile.record_vehicles(self.warmup + step + 1, observation.get_vehicle_count())
+                profile.lap("metrics")
+
+            if self.steady_state is not None and (step + 1) % self.steady_state.batch_size == 0:
+                estimates.append(np.array([metric.report().aggregate for metric in metrics]))
+                if self.steady_state.converged(estimates, step + 1):
+                    return SimulationResult(estimates[-1], self.warmup + step + 1,
+                                            contributions=self._contributions(metrics))
+
+        return SimulationResult(np.array([metric.report().aggregate for metric in metrics]), steps,
+                                contributions=self._contributions(metrics))
 
-        aggregate, _ = metric.report()
+    def _contributions(self, metrics) -> Optional[np.ndarray]:
+        """
+        Sums the lane contributions of the first metric which reports them into a contribution per intersection, or
+        returns None if no metric does. Lanes leading out of the roadnet have no traffic light, so are left out.
+        """
+        metric = next((metric for metric in metrics if hasattr(metric, "contributions")), None)
+        if metric is None:
+            return None
 
-        return np.array([[aggregate]])
+        if self._lane_intersections is None:
+            index = {u: i for i, u in enumerate(self.intersections)}
+            self._lane_intersections = {lane: index[u] for lane, u in
+                                        self._roadnet_template.lane_intersections().items() if u in index}
+
+        contributions = np.zeros(len(self.intersections))
+        for lane, value in metric.contributions().items():
+            i = self._lane_intersections.get(lane)
+            if i is not None:
+                contributions[i] += value
+        return contributions
 
     def multithreaded_evaluate(self, x):
         """
@@ -85,38 +353,81 @@ class Simulator:
         Returns
         -------
         The resulting aggregate metric calculated after N simulation iterations, with traffic light timings x.
+
+        Generated files are written to a scratch directory per process, so evaluate is itself safe to call from
+        multiple processes - this is kept as an alias for it.
         """
-        x = np.array(np.array_split(x.flatten(), len(self.intersections)))
-        if self.timing_period is not None:
-            x3 = self.timing_period - x.sum(axis=1)
-            x = np.insert(x, x.shape[1] - 1, x3, axis=1)
+        return self.evaluate(x)
 
-        traffic_light_phases = {intersection: timing for (intersection, timing) in zip(self.intersections, x.tolist())}
-        roadnet = graph_to_roadnet(self.g, traffic_light_phases, intersection_width=50, lane_width=8)
+    def _get_persistent_engine(self, profile: Optional[EvaluationProfile] = None):
+        """Returns this process' engine, creating it on first use"""
+        # Engines can't be shared with forked workers, so each process creates its own
+        if self._engine is None or self._engine_pid != os.getpid():
+            self._engine = self._create_engine(None, profile, rlTrafficLight=True)
+            self._engine_pid = os.getpid()
 
-        # Generate UUID tag to ensure each thread's config file is unique
-        name = str(uuid.uuid1())[:8]
+            self._warmup_snapshot = None
+            if self.warmup > 0:
+                with stage(profile, "warmup"):
+                    self._warm_up(self._engine)
+                    self._warmup_snapshot = self._engine.snapshot()
+        return self._engine
+
+    def _create_engine(self, traffic_light_phases: Optional[Dict] = None,
+                       profile: Optional[EvaluationProfile] = None, **overrides):
+        """
+        Creates an engine for the graph, with the given traffic light timings baked into its roadnet (or the defaults).
+        Keyword arguments override fields of the base config.
+        """
+        with stage(profile, "roadnet"):
+            roadnet = self._roadnet_template.render(traffic_light_phases)
+        with stage(profile, "flow"):
+            flow = graph_to_flow(self.g, self.strategy)
+        with stage(profile, "write"):
+            config_file = self._write_config(roadnet, flow, **overrides)
 
-        roadnet_file = f"cityflow_config/roadnets/auto_roadnet_{name}.json"
-        with open(roadnet_file, 'w') as f:
-            f.write(json.dumps(roadnet, indent=4))
-        config_file = f"cityflow_config/config_{name}.json"
-        with open(f"cityflow_config/config.json", 'r') as f:
-            config = json.loads(f.read())
+        engine_factory = cityflow_engine if self.engine_factory is None else self.engine_factory
+        with stage(profile, "engine"):
+            return engine_factory(config_file, thread_num=1)
 
-        config["roadnetFile"] = f"roadnets/auto_roadnet_{name}.json"
-        with open(config_file, 'w') as f:
-            f.write(json.dumps(config, indent=4))
+    def _warm_up(self, eng) -> None:
+        """Simulates the warm-up steps on a freshly created engine, under the default traffic light timings"""
+        if self.warmup > 0:
+            schedule = PhaseSchedule(self._roadnet_template.light_schedule(), self._config["interval"])
+            schedule.start(eng)
+            for _ in range(self.warmup):
+                eng.next_step()
+                schedule.step(eng)
 
-        eng = cf.Engine(config_file, thread_num=1)
+    def _write_config(self, roadnet, flow, **overrides) -> str:
+        """
+        Writes (or reuses cached) roadnet, flow and config files for a simulation, returning the config path. Keyword
+        arguments override fields of the base config.
+        """
+        roadnet_file = self._artifacts.path("roadnet", roadnet)
+        flow_file = self._artifacts.path("flow", flow)
 
-        metric = self.metric()
+        # Generated files are not under the base config's directory, so all paths are given relative to the working
+        # directory instead
+        base_dir = self._config["dir"]
+        config = dict(self._config,
+                      dir="",
+                      roadnetFile=roadnet_file,
+                      flowFile=flow_file,
+                      roadnetLogFile=os.path.join(base_dir, self._config["roadnetLogFile"]),
+                      replayLogFile=os.path.join(base_dir, self._config["replayLogFile"]),
+                      # Replays are only saved on demand, through replay
+                      saveReplay=False)
+        config.update(overrides)
+        config_file = self._artifacts.path("config", config)
 
-        for _ in range(self.steps):
-            eng.next_step()
-            metric.update(eng)
+        self._artifacts.evict(keep=(roadnet_file, flow_file, config_file))
+        return config_file
 
-        aggregate, _ = metric.report()
-        os.remove(roadnet_file)
-        os.remove(config_file)
-        return np.array([[aggregate]])
+    def __getstate__(self):
+        # Engines can't be pickled - each process creates its own
+        state = self.__dict__.copy()
+        state["_engine"] = None
+        state["_engine_pid"] = None
+        state["_warmup_snapshot"] = None
+        return state
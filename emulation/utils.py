@@ -1,16 +1,16 @@
-from typing import Optional
+from typing import List, Optional, Union
 
 import numpy as np
 import pandas
 
 
-def results_to_df(x, y, metric_name: str, time_period: Optional[float]):
+def results_to_df(x, y, metric_name: Union[str, List[str]], time_period: Optional[float]):
     """
     Parameters
     ----------
     x:              Array-like (2D) list where each row represents a set of parameter values
-    y:              Array-like (1D) list of results of simulation run
-    metric_name:    Name for results column title
+    y:              Array-like (1D) list of results of simulation run, or (2D) with one column per metric
+    metric_name:    Name for results column title, or list of names for each column of y
     time_period:    If specified, inserts a fourth column for every three parameters in x, and infers value from other three.
 
     Returns
@@ -29,12 +29,75 @@ def results_to_df(x, y, metric_name: str, time_period: Optional[float]):
             node, phase = i // 4, i % 4
             d[f"x_{node}_{phase}"] = np.array(x[:, i])
 
-    d[metric_name] = np.array(y).flatten()
+    if isinstance(metric_name, str):
+        d[metric_name] = np.array(y).flatten()
+    else:
+        y = np.array(y).reshape(len(x), len(metric_name))
+        for i, name in enumerate(metric_name):
+            d[name] = y[:, i]
 
     df = pandas.DataFrame(data=d)
     return df
 
 
+def df_to_x(df: pandas.DataFrame, time_period: Optional[float]) -> np.ndarray:
+    """
+    Parameters
+    ----------
+    df:             Dataframe of results, as returned by results_to_df
+    time_period:    If specified, the fourth column of every intersection is dropped, as it is inferred from the others.
+
+    Returns
+    _______
+    2D array of the parameter values of each row of df - the inverse of results_to_df
+    """
+    columns = [column for column in df.columns if column.startswith("x_")]
+    if time_period is not None:
+        columns = [column for column in columns if not column.endswith("_3")]
+    return df[columns].to_numpy()
+
+
+def pareto_front(y) -> np.ndarray:
+    """
+    Parameters
+    ----------
+    y:  Array-like (2D) list of results, with one column per (minimised) metric
+
+    Returns
+    _______
+    Boolean array marking the rows of y which are not dominated by any other row
+    """
+    y = np.asarray(y)
+    front = np.ones(len(y), dtype=bool)
+    for i, row in enumerate(y):
+        dominated = np.all(y <= row, axis=1) & np.any(y < row, axis=1)
+        front[i] = not dominated.any()
+    return front
+
+
+def independent_blocks(distances: np.ndarray, separation: float) -> List[np.ndarray]:
+    """
+    Parameters
+    ----------
+    distances:  Symmetric (2D) array of the distance between each pair of items, e.g. intersections
+    separation: Distance items in the same block must be more than apart
+
+    Returns
+    _______
+    Partition of the items' indices into blocks, by greedy colouring - each item joins the first block with no item
+    within the separation of it.
+    """
+    blocks: List[List[int]] = []
+    for i in range(len(distances)):
+        for block in blocks:
+            if np.all(distances[i, block] > separation):
+                block.append(i)
+                break
+        else:
+            blocks.append([i])
+    return [np.array(block) for block in blocks]
+
+
 # Test functions
 def forrester(x):
     return (6 * x - 2) ** 2 * np.sin(12 * x - 4)
@@ -1,21 +1,68 @@
 from abc import ABC, abstractmethod
+from array import array
 from dataclasses import dataclass
 from numbers import Number
-from typing import List
+from typing import Dict, Sequence
 
 
 @dataclass
 class Report:
     aggregate: Number
-    data: List[Number]
+    data: Sequence[Number]
 
     def __iter__(self):
         return iter((self.aggregate, self.data))
 
 
+class Series:
+    """
+    Per-step data recorded by a metric. Values can be kept in a list, in a compact array of doubles, or not kept at all
+    (so that only the metric's running aggregate takes up memory), and can be downsampled to every stride-th value.
+    """
+
+    def __init__(self, storage: str = "list", stride: int = 1):
+        if storage == "list":
+            self._values = []
+        elif storage == "array":
+            self._values = array('d')
+        elif storage == "none":
+            self._values = None
+        else:
+            raise ValueError(f"Unknown series storage {storage}")
+
+        self._stride = stride
+        self._count = 0
+
+    def append(self, value: Number) -> None:
+        if self._values is not None and self._count % self._stride == 0:
+            self._values.append(value)
+        self._count += 1
+
+    @property
+    def data(self) -> Sequence[Number]:
+        return [] if self._values is None else self._values
+
+
 class Metric(ABC):
+    def __init__(self, update_every: int = 1, series: str = "list", series_stride: int = 1):
+        """
+        Parameters
+        ----------
+        update_every:   Only update the metric every k steps of the simulation, for metrics that are expensive to
+                        sample.
+        series:         How to store the metric's per-step data - "list", "array" (compact array of doubles) or "none"
+                        (only the aggregate is calculated, in constant memory).
+        series_stride:  Only store every k-th value of the per-step data.
+        """
+        self.update_every = update_every
+        self._series = Series(series, series_stride)
+
     @abstractmethod
     def update(self, eng):
+        """
+        Updates the metric after a step of the simulation. eng is usually an Observation of the engine shared with other
+        metrics, so bulk queries are only made once per step.
+        """
         pass
 
     @abstractmethod
@@ -26,40 +73,83 @@ class Metric(ABC):
 
 
 class CompletedJourneysMetric(Metric):
-    def __init__(self):
-        self._total_vehicles = set()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Vehicles never reappear once they have left the roadnet, so only the previous step's vehicles need to be kept
+        # to count new journeys, and completed journeys follow from the change in the number of vehicles.
+        # Engines don't report how many vehicles have been created or have finished, and list vehicles in no
+        # particular order, so new vehicles can only be found by comparing ids - which hashing does faster than
+        # parsing the flow and index out of every id would.
+        self._total_vehicles = 0
         self._prev_step = set()
-        self._completed_journeys = [0]
+        self._completed_journeys = 0
+        self._series.append(0)
         self.name = 'completed journeys'
 
     def update(self, eng):
         curr_step = set(eng.get_vehicles(include_waiting=True))
-        self._total_vehicles |= curr_step
-        self._completed_journeys.append(len(self._prev_step - curr_step) + self._completed_journeys[-1])
+        new_vehicles = len(curr_step.difference(self._prev_step))
+        self._total_vehicles += new_vehicles
+        self._completed_journeys += len(self._prev_step) + new_vehicles - len(curr_step)
+        self._series.append(self._completed_journeys)
         self._prev_step = curr_step
 
     def report(self) -> Report:
-        return Report(1 - self._completed_journeys[-1]/len(self._total_vehicles), self._completed_journeys)
+        return Report(1 - self._completed_journeys/self._total_vehicles, self._series.data)
 
 
 class WaitTimeMetric(Metric):
     """
-    Reports the overall average waiting time, and the proportion of cars waiting at each time step.
+    Reports the overall average waiting time, and the proportion of cars waiting at each time step. A car is waiting if
+    it is stopped in the roadnet, or queued to enter it - so that traffic blocked at the roadnet's borders counts as
+    waiting, rather than only adding to the number of cars.
     """
 
-    def __init__(self):
-        self._waiting_vehicles = []
-        self._total_vehicles = []
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._waiting_vehicles = 0
+        self._total_vehicles = 0
         self.name = 'wait time'
 
     def update(self, eng):
         vehicles = eng.get_vehicles(include_waiting=True)
-        wait_time = sum([float(eng.get_vehicle_info(v)['speed']) < 0.1 for v in vehicles])
-        self._total_vehicles.append(len(vehicles))
-        self._waiting_vehicles.append(wait_time)
+        # Speeds are only reported for the cars running in the roadnet. CityFlow defines a waiting car as one with
+        # speed < 0.1.
+        speeds = eng.get_vehicle_speed()
+        queued = len(vehicles) - len(speeds)
+        wait_time = sum([speed < 0.1 for speed in speeds.values()]) + queued
+        self._total_vehicles += len(vehicles)
+        self._waiting_vehicles += wait_time
+        self._series.append(wait_time / len(vehicles) if len(vehicles) > 0 else 0)
+
+    def report(self) -> Report:
+        return Report(self._waiting_vehicles / self._total_vehicles, self._series.data)
+
+
+class LaneWaitingMetric(Metric):
+    """
+    Reports the average number of vehicles waiting (in a queue) per step, over the whole roadnet. The waiting of each
+    lane is kept, so that the metric can be broken down into the contributions of the intersections the lanes lead to.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lane_waiting: Dict[str, int] = {}
+        self._updates = 0
+        self.name = 'lane waiting'
+
+    def update(self, eng):
+        waiting = eng.get_lane_waiting_vehicle_count()
+        totals = self._lane_waiting
+        for lane, count in waiting.items():
+            if count > 0:
+                totals[lane] = totals.get(lane, 0) + count
+        self._updates += 1
+        self._series.append(sum(waiting.values()))
+
+    def contributions(self) -> Dict[str, float]:
+        """Average number of vehicles waiting per step in each lane, for the lanes where any vehicle waited"""
+        return {lane: total / self._updates for lane, total in self._lane_waiting.items()}
 
     def report(self) -> Report:
-        total_average = sum(self._waiting_vehicles) / sum(self._total_vehicles)
-        proportion_waiting = [wait / total if total > 0 else 0 for wait, total in
-                              zip(self._waiting_vehicles, self._total_vehicles)]
-        return Report(total_average, proportion_waiting)
+        return Report(sum(self._lane_waiting.values()) / self._updates if self._updates > 0 else 0, self._series.data)
@@ -0,0 +1,43 @@
+from typing import Dict, List
+
+
+class Observation:
+    """
+    Per-step view of a CityFlow engine, shared between all metrics updated on that step.
+
+    Each engine query is made at most once per step, however many metrics ask for it, so metrics should prefer the
+    engine's bulk getters (e.g. get_vehicle_speed) over per-vehicle ones (e.g. get_vehicle_info). Any other engine
+    methods are passed straight through to the engine.
+    """
+
+    def __init__(self, eng):
+        self._eng = eng
+        self._results = {}
+
+    def refresh(self) -> None:
+        """Discards the previous step's query results - to be called after each step of the engine"""
+        self._results.clear()
+
+    def _query(self, name: str, *args):
+        key = (name, *args)
+        if key not in self._results:
+            self._results[key] = getattr(self._eng, name)(*args)
+        return self._results[key]
+
+    def get_vehicles(self, include_waiting: bool = False) -> List[str]:
+        return self._query("get_vehicles", include_waiting)
+
+    def get_vehicle_count(self) -> int:
+        return self._query("get_vehicle_count")
+
+    def get_vehicle_speed(self) -> Dict[str, float]:
+        return self._query("get_vehicle_speed")
+
+    def get_lane_vehicle_count(self) -> Dict[str, int]:
+        return self._query("get_lane_vehicle_count")
+
+    def get_lane_waiting_vehicle_count(self) -> Dict[str, int]:
+        return self._query("get_lane_waiting_vehicle_count")
+
+    def __getattr__(self, name):
+        return getattr(self._eng, name)
@@ -0,0 +1,184 @@
+from typing import Any, Callable, Dict, FrozenSet, Hashable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import shortest_path
+
+from simulation_builder.graph import Graph
+
+Vertex = Tuple[int, int]
+D = TypeVar("D")
+
+
+class CompactGraph:
+    """
+    Frozen, array-backed version of Graph, for graphs whose vertices are (x, y) coordinates.
+
+    Vertices are numbered 0..n-1 in the order the Graph iterates over them, and the adjacency is stored in compressed
+    sparse row (CSR) form: the neighbours of vertex i are indices[indptr[i]:indptr[i + 1]], in the same order as the
+    Graph's. Each entry k of the adjacency is the road from its row's vertex to indices[k], with its direction (as given
+    by Road) in directions[k].
+
+    CompactGraph supports the read-only parts of Graph's interface, iterating in the same order, so can be passed to the
+    roadnet, flow and simulator code in its place. Derived products are cached on it for its lifetime.
+    """
+
+    def __init__(self, vertices: List[Vertex], indptr: np.ndarray, indices: np.ndarray):
+        """
+        Args:
+            vertices: The (x, y) coordinates of each vertex, indexed by id
+            indptr: CSR row pointers, with len(vertices) + 1 entries
+            indices: CSR column indices, giving the id of each neighbour
+        """
+        self.vertices = list(vertices)
+        self.index: Dict[Vertex, int] = {v: i for i, v in enumerate(self.vertices)}
+
+        self.coordinates = np.array(self.vertices, dtype=float).reshape(len(self.vertices), 2)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.degree = np.diff(self.indptr)
+
+        # The vertex each adjacency entry (road) starts from
+        self.sources = np.repeat(np.arange(len(self.vertices)), self.degree)
+        self.directions = _road_directions(self.coordinates[self.sources], self.coordinates[self.indices])
+
+        for array in (self.coordinates, self.indptr, self.indices, self.degree, self.sources, self.directions):
+            array.setflags(write=False)
+
+        self._keys = None
+        self._adjacency_list = None
+        # The editable graph this is a copy of, and its version when copied
+        self._source: Optional[Tuple[Graph, int]] = None
+        self._derived: Dict[Hashable, Any] = {}
+        self._vertex_derived: Dict[Vertex, Dict[Hashable, Any]] = {}
+
+    @staticmethod
+    def from_graph(g: Union[Graph, "CompactGraph"]) -> "CompactGraph":
+        """
+        Returns a compact copy of g, or g itself if it is already compact. The copy is cached on g until it is edited,
+        and starts with the products already derived from g's current version.
+        """
+        if isinstance(g, CompactGraph):
+            return g
+        return g.derived("compact", lambda: CompactGraph._copy(g))
+
+    @staticmethod
+    def _copy(g: Graph) -> "CompactGraph":
+        vertices = list(g)
+        index = {v: i for i, v in enumerate(vertices)}
+        neighbours = [[index[v] for v in g[u]] for u in vertices]
+
+        indptr = np.zeros(len(vertices) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(row) for row in neighbours])
+        indices = np.fromiter((v for row in neighbours for v in row), dtype=np.int64, count=indptr[-1])
+
+        compact = CompactGraph(vertices, indptr, indices)
+        compact._source = (g, g.version)
+        compact._derived = {name: product for name, (version, product) in g._derived.items() if version == g.version}
+        compact._vertex_derived = {u: dict(products) for u, products in g._vertex_derived.items()}
+        return compact
+
+    def derived(self, name: Hashable, build: Callable[[], D], update=None) -> D:
+        """
+        As Graph.derived - as the graph is frozen, products are built once and never updated. Products which can be
+        updated after edits (such as ShortestPaths) are cached on the graph this is a copy of, while it is unedited, so
+        that they carry over to the copies of its later versions.
+        """
+        if update is not None and self._source is not None:
+            source, version = self._source
+            if source.version == version:
+                return source.derived(name, build, update)
+
+        if name not in self._derived:
+            self._derived[name] = build()
+        return self._derived[name]
+
+    def vertex_derived(self, vertex: Vertex, name: Hashable, build: Callable[[], D]) -> D:
+        """As Graph.vertex_derived"""
+        products = self._vertex_derived.setdefault(vertex, {})
+        if name not in products:
+            products[name] = build()
+        return products[name]
+
+    def vertex_derived_many(self, vertices: List[Vertex], name: Hashable,
+                            build: Callable[[List[Vertex]], Dict[Vertex, D]]) -> Dict[Vertex, D]:
+        """As Graph.vertex_derived_many"""
+        missing = [u for u in vertices if name not in self._vertex_derived.get(u, {})]
+        if missing:
+            for u, product in build(missing).items():
+                self._vertex_derived.setdefault(u, {})[name] = product
+        return {u: self._vertex_derived[u][name] for u in vertices}
+
+    @property
+    def intersections(self) -> np.ndarray:
+        """Ids of the vertices joining more than two roads, which have traffic lights"""
+        return np.flatnonzero(self.degree > 2)
+
+    @property
+    def endpoints(self) -> np.ndarray:
+        """Ids of the vertices at the end of a single road, where flows start and end"""
+        return np.flatnonzero(self.degree == 1)
+
+    def neighbours(self, i: int) -> np.ndarray:
+        """Ids of the neighbours of vertex i"""
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def hops(self, sources: np.ndarray) -> np.ndarray:
+        """
+        Number of roads on the shortest path from each of the source vertex ids to every vertex, as a (sources, vertices)
+        array - inf where a vertex can't be reached
+        """
+        adjacency = csr_matrix((np.ones(len(self.indices)), self.indices, self.indptr), shape=(len(self), len(self)))
+        return shortest_path(adjacency, unweighted=True, indices=np.asarray(sources, dtype=np.int64)).reshape(
+            len(sources), len(self))
+
+    @property
+    def adjacency_list(self) -> Dict[Vertex, FrozenSet[Vertex]]:
+        if self._adjacency_list is None:
+            self._adjacency_list = {u: frozenset(self[u]) for u in self.vertices}
+        return self._adjacency_list
+
+    def __getstate__(self):
+        # The editable graph stays in the process which copied it
+        state = self.__dict__.copy()
+        state["_source"] = None
+        return state
+
+    def __getitem__(self, index: Vertex) -> Tuple[Vertex, ...]:
+        i = self.index[index]
+        return tuple(self.vertices[v] for v in self.neighbours(i))
+
+    def __iter__(self) -> Iterator[Vertex]:
+        yield from self.vertices
+
+    def __len__(self) -> int:
+        return len(self.vertices)
+
+    def __contains__(self, index: Vertex) -> bool:
+        return index in self.index
+
+    def keys(self) -> FrozenSet[Vertex]:
+        # Built the same way as Graph.keys(), so that it iterates in the same order
+        if self._keys is None:
+            self._keys = frozenset(self.index.keys())
+        return self._keys
+
+    def __str__(self) -> str:
+        return str(self.adjacency_list)
+
+    def __getstate__(self):
+        # Derived arrays and products are rebuilt on unpickling, rather than sent between processes
+        return {"vertices": self.vertices, "indptr": self.indptr, "indices": self.indices}
+
+    def __setstate__(self, state):
+        self.__init__(state["vertices"], state["indptr"], state["indices"])
+
+
+def _road_directions(start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    """Vectorised Road.direction, for roads between each row of start and end"""
+    vertical = start[:, 0] == end[:, 0]
+    horizontal = start[:, 1] == end[:, 1]
+    return np.select([vertical & (start[:, 1] < end[:, 1]),
+                      vertical & (start[:, 1] > end[:, 1]),
+                      horizontal & (start[:, 0] < end[:, 0])],
+                     [1, 3, 0], default=2).astype(np.int8)
@@ -1,11 +1,24 @@
-import math
 from logging import warning
 
 from numpy import random
 from typing import Dict, List, Tuple, Optional
 
 from simulation_builder.graph import Graph, Road
-import heapq as hq
+from simulation_builder.routing import ShortestPaths
+
+
+# Vehicle template shared by every flow's JSON, which should not be modified
+VEHICLE = {
+    "length": 5.0,
+    "width": 2.0,
+    "maxPosAcc": 2.0,
+    "maxNegAcc": 4.5,
+    "usualPosAcc": 2.0,
+    "usualNegAcc": 4.5,
+    "minGap": 2.5,
+    "maxSpeed": 12.67,
+    "headwayTime": 1.5
+}
 
 
 class Flow:
@@ -16,17 +29,7 @@ class Flow:
 
     def json(self) -> Dict:
         return {
-            "vehicle": {
-                "length": 5.0,
-                "width": 2.0,
-                "maxPosAcc": 2.0,
-                "maxNegAcc": 4.5,
-                "usualPosAcc": 2.0,
-                "usualNegAcc": 4.5,
-                "minGap": 2.5,
-                "maxSpeed": 12.67,
-                "headwayTime": 1.5
-            },
+            "vehicle": VEHICLE,
             "route": self.route,
             "interval": self._interval,
             "startTime": 0,
@@ -82,56 +85,23 @@ class CustomEndpointFlowStrategy(FlowStrategy):
             return [Flow(route, interval=self._default)]
 
 
-def graph_to_flow(g: Graph, strategy: FlowStrategy = FlowStrategy()) -> List[Dict]:
-    paths = all_pairs_shortest_paths(g)
+def graph_to_flow(g: Graph, strategy: FlowStrategy = FlowStrategy(), weighted: bool = False) -> List[Dict]:
+    paths = all_pairs_shortest_paths(g, weighted)
     flows = []
-    for start in paths:
-        for end in paths[start]:
-            flows += [flow.json() for flow in strategy.gen_flows(paths[start][end])]
+    for start, routes in paths.items():
+        for end, route in routes.items():
+            flows += [flow.json() for flow in strategy.gen_flows(route)]
     return flows
 
 
-def all_pairs_shortest_paths(g: Graph) -> Dict:
+def all_pairs_shortest_paths(g: Graph, weighted: bool = False) -> ShortestPaths:
     """
     Args:
         g: An undirected Graph
+        weighted: Whether paths minimise the total length of their roads, rather than the number of roads
 
     Returns:
-        A dictionary of dictionaries of paths, where each one represents the shortest path between an
-        endpoint and all other endpoints.
+        A mapping of mappings of paths, where each one represents the shortest path between an endpoint and all other
+        (reachable) endpoints. Paths are computed as they are looked up, and cached on g - see ShortestPaths.
     """
-
-    endpoints = [v for v in g.keys() if len(g[v]) == 1]
-
-    flows = {source: {} for source in endpoints}
-
-    for source in endpoints:
-        dist = {source: 0}
-        prev = {}
-
-        heap = [(0, source)]
-        for v in g.keys():
-            if v != source:
-                dist[v] = math.inf
-            prev[v] = None
-
-        while len(heap) != 0:
-            _, u = hq.heappop(heap)
-            for v in g[u]:
-                alt = dist[u] + 1
-                if alt < dist[v]:
-                    dist[v] = alt
-                    prev[v] = u
-                    hq.heappush(heap, (alt, v))
-
-        routes = {}
-        for v in endpoints:
-            if v != source:
-                route = [v]
-                u = prev[v]
-                while u is not None:
-                    route.insert(0, u)
-                    u = prev[u]
-                routes[v] = route
-        flows[source] = routes
-    return flows
+    return ShortestPaths.of(g, weighted)
@@ -1,6 +1,10 @@
-from typing import List, TypeVar, Tuple, Set, Iterable, Dict
+from typing import Any, Callable, List, Optional, TypeVar, Tuple, Set, Iterable, Dict, Hashable
 
 T = TypeVar("T")
+D = TypeVar("D")
+
+# A change to a directed edge (u, v) of a graph, and whether it was added (or removed)
+Edit = Tuple[T, T, bool]
 
 
 class Graph:
@@ -8,6 +12,11 @@ class Graph:
     Data structure for undirected graph, using adjacency list representation. Will automatically generate reversed
     edges for each edge given to constructor (i.e. specifying Graph([1, 2], (1, 2)) will generate edges (1, 2)
     and (2, 1).
+
+    Products derived from the graph (such as its shortest paths, or its roadnet's intersections) can be cached on it
+    with derived and vertex_derived. Every edit made through add_edge, remove_edge or __setitem__ bumps the graph's
+    version and invalidates what depends on the edited vertices - edits made to adjacency_list directly are not
+    tracked.
     """
 
     def __init__(self, vertices: List[T], edges: List[Tuple[T, T]]):
@@ -16,6 +25,13 @@ class Graph:
             self.adjacency_list[u].add(v)
             self.adjacency_list[v].add(u)
 
+        self.version = 0
+        # Whole graph products, as name -> (version built at, product), and the edits made since the oldest of them
+        self._derived: Dict[Hashable, Tuple[int, Any]] = {}
+        self._edits: List[Tuple[int, Edit]] = []
+        # Products which only depend on a single vertex's edges, as vertex -> name -> product
+        self._vertex_derived: Dict[T, Dict[Hashable, Any]] = {}
+
     def __str__(self) -> str:
         return str(self.adjacency_list)
 
@@ -26,7 +42,10 @@ class Graph:
     def __setitem__(self, index: T, items: Iterable[T]) -> None:
         if index not in self.adjacency_list.keys():
             self.adjacency_list[index] = set()
-        self.adjacency_list[index] = set(items)
+        items = set(items)
+        old = self.adjacency_list[index]
+        self.adjacency_list[index] = items
+        self._edited([(index, v, False) for v in old - items] + [(index, v, True) for v in items - old])
 
     def __iter__(self):
         yield from self.adjacency_list.keys()
@@ -34,6 +53,98 @@ class Graph:
     def keys(self) -> Set[T]:
         return set(self.adjacency_list.keys())
 
+    def add_edge(self, u: T, v: T) -> None:
+        """Adds an (undirected) edge between u and v, adding either vertex if it is not already in the graph"""
+        edits = []
+        for a, b in ((u, v), (v, u)):
+            neighbours = self.adjacency_list.setdefault(a, set())
+            if b not in neighbours:
+                neighbours.add(b)
+                edits.append((a, b, True))
+        self._edited(edits)
+
+    def remove_edge(self, u: T, v: T) -> None:
+        """Removes the (undirected) edge between u and v"""
+        edits = []
+        for a, b in ((u, v), (v, u)):
+            if b in self.adjacency_list.get(a, ()):
+                self.adjacency_list[a].remove(b)
+                edits.append((a, b, False))
+        self._edited(edits)
+
+    def endpoints(self) -> List[T]:
+        """Vertices at the end of a single road, where flows start and end, in the order of keys()"""
+        return self.derived("endpoints", lambda: [v for v in self.keys() if len(self[v]) == 1])
+
+    def intersections(self) -> List[T]:
+        """Vertices joining more than two roads, which have traffic lights, in sorted order"""
+        return self.derived("intersections", lambda: sorted(v for v in self if len(self[v]) > 2))
+
+    def derived(self, name: Hashable, build: Callable[[], D],
+                update: Optional[Callable[[D, List[Edit]], D]] = None) -> D:
+        """
+        Args:
+            name: Name to cache the product under
+            build: Builds the product from scratch
+            update: Optionally, updates a product built before the graph was last edited, given the edits made since
+                    then (in order), rather than building it from scratch
+
+        Returns:
+            The named product for the current version of the graph, built (or updated) if it is not cached.
+        """
+        if name in self._derived:
+            version, product = self._derived[name]
+            if version == self.version:
+                return product
+            if update is not None:
+                product = update(product, [edit for edit_version, edit in self._edits if edit_version > version])
+            else:
+                product = build()
+        else:
+            product = build()
+
+        self._derived[name] = (self.version, product)
+        # Edits are only kept for as long as a product needs them
+        oldest = min(version for version, _ in self._derived.values())
+        self._edits = [(version, edit) for version, edit in self._edits if version > oldest]
+        return product
+
+    def vertex_derived(self, vertex: T, name: Hashable, build: Callable[[], D]) -> D:
+        """
+        Args:
+            vertex: Vertex which the product is derived from
+            name: Name to cache the product under
+            build: Builds the product, from the vertex and its (outgoing) edges only
+
+        Returns:
+            The named product for the vertex, which is only rebuilt if the vertex's edges have been edited.
+        """
+        products = self._vertex_derived.setdefault(vertex, {})
+        if name not in products:
+            products[name] = build()
+        return products[name]
+
+    def vertex_derived_many(self, vertices: List[T], name: Hashable,
+                            build: Callable[[List[T]], Dict[T, D]]) -> Dict[T, D]:
+        """
+        As vertex_derived, for many vertices at once - build is called once, with the vertices whose products are not
+        cached, and returns a dictionary of their products.
+        """
+        missing = [u for u in vertices if name not in self._vertex_derived.get(u, {})]
+        if missing:
+            for u, product in build(missing).items():
+                self._vertex_derived.setdefault(u, {})[name] = product
+        return {u: self._vertex_derived[u][name] for u in vertices}
+
+    def _edited(self, edits: List[Edit]) -> None:
+        if not edits:
+            return
+        self.version += 1
+        for u, _, _ in edits:
+            self._vertex_derived.pop(u, None)
+        if self._derived:
+            self._edits += [(self.version, edit) for edit in edits]
+
 
 # TODO: Review whether to put in separate file
 class Road:
@@ -113,6 +224,27 @@ def spiral_graph(n: int, width: int = 100) -> Graph:
     return Graph(vertices, edges)
 
 
+def grid_graph(rows: int, cols: int, width: int = 100) -> Graph:
+    """
+    Returns a rows x cols lattice of intersections, with an endpoint connected to each intersection on the lattice's
+    border by a road leading straight out of it.
+    """
+    vertices = [(i * width, j * width) for i in range(cols) for j in range(rows)]
+    edges = [((i * width, j * width), ((i + 1) * width, j * width)) for i in range(cols - 1) for j in range(rows)] + \
+            [((i * width, j * width), (i * width, (j + 1) * width)) for i in range(cols) for j in range(rows - 1)]
+
+    for i in range(cols):
+        for j, outside in ((0, -1), (rows - 1, rows)):
+            edges.append(((i * width, j * width), (i * width, outside * width)))
+            vertices.append((i * width, outside * width))
+    for j in range(rows):
+        for i, outside in ((0, -1), (cols - 1, cols)):
+            edges.append(((i * width, j * width), (outside * width, j * width)))
+            vertices.append((outside * width, j * width))
+
+    return Graph(vertices, edges)
+
+
 def I_graph() -> Graph:
     return Graph(vertices=[(-400, 0), (0, 0), (400, 0), (-400, 400), (0, 400), (400, 400)],
                  edges=[((-400, 0), (0, 0)),
@@ -1,6 +1,6 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Set, Tuple
 
-from simulation_builder.geometry import find_path
+from simulation_builder.geometry import find_paths, pointToDict3
 from simulation_builder.graph import Graph, Road
 
 
@@ -18,9 +18,8 @@ def graph_to_roadnet(g: Graph, traffic_light_phases: Optional[Dict] = None, inte
     roads = []
 
     for u in g:
-        for v in g[u]:
-            road = Road(u, v, lane_width, lane_speed)
-            roads.append(road.json())
+        roads += g.vertex_derived(u, ("roads", lane_width, lane_speed),
+                                  lambda: [Road(u, v, lane_width, lane_speed).json() for v in g[u]])
 
     intersections = gen_intersections(g, traffic_light_phases, intersection_width, lane_width, lane_speed)
 
@@ -32,6 +31,11 @@ def graph_to_roadnet(g: Graph, traffic_light_phases: Optional[Dict] = None, inte
 
 def gen_intersections(g: Graph, traffic_light_phases: Optional[Dict], intersection_width=50, lane_width=4,
                       lane_speed=20) -> List[Dict]:
+    # Road links only depend on each intersection's roads, so are cached on g - and shared between the roadnets
+    # generated from it
+    links = g.vertex_derived_many([u for u in g if len(g[u]) > 1], ("road_links", intersection_width),
+                                  lambda vertices: gen_road_links(g, vertices, intersection_width))
+
     intersections = []
     for u in g:
         x, y = u
@@ -95,65 +99,14 @@ def gen_intersections(g: Graph, traffic_light_phases: Optional[Dict], intersecti
             intersection["virtual"] = True
         else:
             intersection["width"] = intersection_width
-            # Store dictionary of roads indexed by direction
-            incoming_roads = {}
-            outgoing_roads = {}
-            for v in g[u]:
-                in_road = Road(v, u)
-                out_road = Road(u, v)
-                incoming_roads[in_road.direction] = in_road
-                outgoing_roads[out_road.direction] = out_road
-
-            intersection["roads"] = [road.name() for road in
-                                     list(incoming_roads.values()) + (list(outgoing_roads.values()))]
-
-            road_links = []
-            # For each incoming road, iterate over all three possible directions. If there is a matching outgoing road,
-            # create a road link to it.
-            for in_dir, in_road in incoming_roads.items():
-                for turn_dir in [-1, 0, 1]:
-                    if (out_dir := (turn_dir + in_dir) % 4) in outgoing_roads:
-                        out_road = outgoing_roads[out_dir]
-                        road_link = {
-                            "type": "turn_left" if turn_dir == 1 else "turn_right" if turn_dir == -1 else "go_straight",
-                            "startRoad": in_road.name(),
-                            "endRoad": out_road.name(),
-                            "direction": in_dir,
-                            "laneLinks": []
-                        }
-
-                        for out_lane in range(3):
-                            # Lane 0 turns left, 1 goes straight and 2 turns right
-                            in_lane = 1 - turn_dir
-                            lane_link = {
-                                "startLaneIndex": in_lane,
-                                "endLaneIndex": out_lane,
-                                "points": find_path(in_road, in_lane, out_road, out_lane, intersection_width)
-                            }
-                            road_link["laneLinks"].append(lane_link)
-
-                        road_links.append(road_link)
+            intersection["roads"], road_links = links[u]
             intersection["roadLinks"] = road_links
 
             road_link_indices = list(range(len(road_links)))
+            light_phases = gen_light_phases(road_links)
 
-            # Define predicates on road link type to determine valid traffic light phases
-            left_road_links = set(filter(lambda i: road_links[i]["type"] == "turn_left", road_link_indices))
-            straight_road_links = set(filter(lambda i: road_links[i]["type"] == "go_straight", road_link_indices))
-            right_road_links = set(filter(lambda i: road_links[i]["type"] == "turn_right", road_link_indices))
-            WE_road_links = set(filter(lambda i: road_links[i]["direction"] == 0, road_link_indices))
-            SN_road_links = set(filter(lambda i: road_links[i]["direction"] == 1, road_link_indices))
-            EW_road_links = set(filter(lambda i: road_links[i]["direction"] == 2, road_link_indices))
-            NS_road_links = set(filter(lambda i: road_links[i]["direction"] == 3, road_link_indices))
-
-            light_phases = [
-                ((EW_road_links | WE_road_links) & straight_road_links) | right_road_links,
-                ((EW_road_links | WE_road_links) & left_road_links) | right_road_links,
-                ((NS_road_links | SN_road_links) & straight_road_links) | right_road_links,
-                ((SN_road_links | NS_road_links) & left_road_links) | right_road_links
-            ]
-
-            if traffic_light_phases is None:
+            # Intersections without specified timings (e.g. joining two roads) fall back to default timings
+            if traffic_light_phases is None or u not in traffic_light_phases:
                 processed_light_phases = [{"time": 30, "availableRoadLinks": list(phase)}
                                           for phase in light_phases if len(phase) > 0]
             else:
@@ -169,3 +122,185 @@ def gen_intersections(g: Graph, traffic_light_phases: Optional[Dict], intersecti
         intersections.append(intersection)
 
     return intersections
+
+
+def gen_road_links(g: Graph, vertices: List, intersection_width=50) -> Dict:
+    """
+    Params:
+        g: A graph specifying road connections
+        vertices: (Non-virtual) intersections of g
+        intersection_width: Width of the intersections
+
+    Returns:
+        A dictionary mapping each of the vertices to the names of the roads into and out of it, and the road links
+        between them. The lane link curves of every intersection are computed together in a single batch.
+    """
+    links = {}
+    lane_links = []
+    curves = []
+    for u in vertices:
+        # Store dictionary of roads indexed by direction
+        incoming_roads = {}
+        outgoing_roads = {}
+        for v in g[u]:
+            in_road = Road(v, u)
+            out_road = Road(u, v)
+            incoming_roads[in_road.direction] = in_road
+            outgoing_roads[out_road.direction] = out_road
+
+        roads = [road.name() for road in list(incoming_roads.values()) + (list(outgoing_roads.values()))]
+
+        road_links = []
+        # For each incoming road, iterate over all three possible directions. If there is a matching outgoing road,
+        # create a road link to it.
+        for in_dir, in_road in incoming_roads.items():
+            for turn_dir in [-1, 0, 1]:
+                if (out_dir := (turn_dir + in_dir) % 4) in outgoing_roads:
+                    out_road = outgoing_roads[out_dir]
+                    road_link = {
+                        "type": "turn_left" if turn_dir == 1 else "turn_right" if turn_dir == -1 else "go_straight",
+                        "startRoad": in_road.name(),
+                        "endRoad": out_road.name(),
+                        "direction": in_dir,
+                        "laneLinks": []
+                    }
+
+                    for out_lane in range(3):
+                        # Lane 0 turns left, 1 goes straight and 2 turns right
+                        in_lane = 1 - turn_dir
+                        lane_link = {
+                            "startLaneIndex": in_lane,
+                            "endLaneIndex": out_lane,
+                            "points": None
+                        }
+                        road_link["laneLinks"].append(lane_link)
+                        lane_links.append(lane_link)
+                        curves.append((in_road, in_lane, out_road, out_lane))
+
+                    road_links.append(road_link)
+
+        links[u] = (roads, road_links)
+
+    for lane_link, points in zip(lane_links, find_paths(curves, intersection_width).tolist()):
+        lane_link["points"] = list(map(pointToDict3, points))
+
+    return links
+
+
+def gen_light_phases(road_links: List[Dict]) -> List[Set[int]]:
+    """
+    Params:
+        road_links: The roadLinks of a (non-virtual) intersection.
+
+    Returns:
+        The indices of the road links available in each of the four traffic light phases. Phases may be empty, in which
+        case they are omitted from the generated roadnet.
+    """
+    road_link_indices = list(range(len(road_links)))
+
+    # Define predicates on road link type to determine valid traffic light phases
+    left_road_links = set(filter(lambda i: road_links[i]["type"] == "turn_left", road_link_indices))
+    straight_road_links = set(filter(lambda i: road_links[i]["type"] == "go_straight", road_link_indices))
+    right_road_links = set(filter(lambda i: road_links[i]["type"] == "turn_right", road_link_indices))
+    WE_road_links = set(filter(lambda i: road_links[i]["direction"] == 0, road_link_indices))
+    SN_road_links = set(filter(lambda i: road_links[i]["direction"] == 1, road_link_indices))
+    EW_road_links = set(filter(lambda i: road_links[i]["direction"] == 2, road_link_indices))
+    NS_road_links = set(filter(lambda i: road_links[i]["direction"] == 3, road_link_indices))
+
+    return [
+        ((EW_road_links | WE_road_links) & straight_road_links) | right_road_links,
+        ((EW_road_links | WE_road_links) & left_road_links) | right_road_links,
+        ((NS_road_links | SN_road_links) & straight_road_links) | right_road_links,
+        ((SN_road_links | NS_road_links) & left_road_links) | right_road_links
+    ]
+
+
+class RoadnetTemplate:
+    """
+    Precompiled roadnet for a graph, in which only the traffic light phase timings are left to be filled in.
+
+    Generating a roadnet from scratch builds every road, road link and lane link curve, none of which depend on the
+    traffic light timings. The template generates these once, so that rendering a roadnet for a new set of timings only
+    costs O(intersections).
+    """
+
+    def __init__(self, g: Graph, intersection_width=50, lane_width=4, lane_speed=20):
+        self._roadnet = graph_to_roadnet(g, None, intersection_width, lane_width, lane_speed)
+        self._vertices = list(g)
+
+        # For each non-virtual intersection, store the indices of the (non-empty) light phases that are kept in the
+        # roadnet, so that timings can be matched up with them.
+        self._phase_indices = {}
+        for u, intersection in zip(self._vertices, self._roadnet["intersections"]):
+            if not intersection["virtual"]:
+                self._phase_indices[u] = [i for i, phase in enumerate(gen_light_phases(intersection["roadLinks"]))
+                                          if len(phase) > 0]
+
+    def phase_durations(self, traffic_light_phases: Dict) -> Dict:
+        """
+        Params:
+            traffic_light_phases: A dictionary, mapping each intersection to a list of traffic light phase timings.
+
+        Returns:
+            A dictionary mapping each intersection with specified timings to the durations of its light phases, in
+            roadnet order.
+        """
+        return {u: [traffic_light_phases[u][i] for i in indices if i < len(traffic_light_phases[u])]
+                for u, indices in self._phase_indices.items() if u in traffic_light_phases}
+
+    def light_schedule(self, traffic_light_phases: Optional[Dict] = None) -> Dict[str, List[float]]:
+        """
+        Params:
+            traffic_light_phases: An (optional) dictionary, mapping each intersection to a list of traffic light phase
+                                  timings.
+
+        Returns:
+            A dictionary mapping the id of every non-virtual intersection to the durations of its light phases, in
+            roadnet order. Intersections without specified timings use the default timings.
+        """
+        durations = self.phase_durations({} if traffic_light_phases is None else traffic_light_phases)
+        return {intersection["id"]: durations[u] if u in durations else
+                [phase["time"] for phase in intersection["trafficLight"]["lightphases"]]
+                for u, intersection in zip(self._vertices, self._roadnet["intersections"]) if not intersection["virtual"]}
+
+    def lane_intersections(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Returns:
+            A dictionary mapping the id of every lane (as CityFlow names them) to the vertex of the intersection its
+            road leads into.
+        """
+        vertices = {intersection["id"]: u for u, intersection in zip(self._vertices, self._roadnet["intersections"])}
+        return {f"{road['id']}_{i}": vertices[road["endIntersection"]]
+                for road in self._roadnet["roads"] for i in range(len(road["lanes"]))}
+
+    def render(self, traffic_light_phases: Optional[Dict] = None) -> Dict:
+        """
+        Params:
+            traffic_light_phases: An (optional) dictionary, mapping each intersection to a list of traffic light phase
+                                  timings.
+
+        Returns:
+             A dictionary representing the roadnet, identical to graph_to_roadnet with the same arguments. Roads and road
+             links are shared between rendered roadnets, so should not be modified.
+        """
+        if traffic_light_phases is None:
+            return self._roadnet
+
+        durations = self.phase_durations(traffic_light_phases)
+
+        intersections = []
+        for u, intersection in zip(self._vertices, self._roadnet["intersections"]):
+            if u in durations:
+                light_phases = intersection["trafficLight"]["lightphases"]
+                intersection = dict(intersection)
+                intersection["trafficLight"] = {
+                    "roadLinkIndices": intersection["trafficLight"]["roadLinkIndices"],
+                    "lightphases": [{"time": t, "availableRoadLinks": phase["availableRoadLinks"]}
+                                    for phase, t in zip(light_phases, durations[u])]
+                }
+            intersections.append(intersection)
+
+        return {
+            "intersections": intersections,
+            "roads": self._roadnet["roads"]
+        }
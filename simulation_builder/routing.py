@@ -0,0 +1,184 @@
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Tuple, TypeVar
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from simulation_builder.compact import CompactGraph
+from simulation_builder.graph import Edit, Graph
+
+T = TypeVar("T")
+
+
+class ShortestPaths(Mapping):
+    """
+    Shortest paths from every endpoint (vertex of degree one) of a graph to every other endpoint, as a mapping of
+    source to a mapping of destination to route.
+
+    Each source's shortest path tree is computed the first time it is looked up, and kept. Routes are only built from
+    the tree when they are looked up.
+
+    With unit weights, trees are found by breadth first search, and ties between routes are broken in favour of the
+    smaller vertex - choosing the same routes as a Dijkstra search over a heap of (distance, vertex). Weighted (road
+    length) trees are found with scipy's Dijkstra.
+    """
+
+    def __init__(self, g: Graph, weighted: bool = False):
+        """
+        Args:
+            g: An undirected Graph (or CompactGraph), with (x, y) vertices
+            weighted: Whether paths minimise the total length of their roads, rather than the number of roads
+        """
+        self.weighted = weighted
+
+        g = CompactGraph.from_graph(g)
+        # Vertices are numbered in sorted order, which ties between routes are broken by
+        order = np.lexsort((g.coordinates[:, 1], g.coordinates[:, 0]))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+
+        self._vertices = [g.vertices[i] for i in order]
+        self._index = {v: i for i, v in enumerate(self._vertices)}
+        # Endpoints are kept in the order of the graph's keys, which sets the order of the generated flows
+        self._endpoints = [v for v in g.keys() if g.degree[g.index[v]] == 1]
+        self._endpoint_set = set(self._endpoints)
+
+        if weighted:
+            weights = np.hypot(*(g.coordinates[g.indices] - g.coordinates[g.sources]).T)
+        else:
+            weights = np.ones(len(g.indices))
+        n = len(self._vertices)
+        self._adjacency = csr_matrix((weights, (rank[g.sources], rank[g.indices])), shape=(n, n))
+        # Each row of the transpose lists the vertices with a road into the row's vertex, in sorted order
+        self._incoming = self._adjacency.T.tocsr()
+        self._incoming.sort_indices()
+        self._incoming_rows = np.repeat(np.arange(n), np.diff(self._incoming.indptr))
+
+        # Shortest path tree from each source looked up so far, as (distances, predecessors) arrays
+        self._trees: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+    @staticmethod
+    def of(g: Graph, weighted: bool = False) -> "ShortestPaths":
+        """
+        Returns the shortest paths of g, which are cached on it. When g is edited, the trees which the edits could not
+        have changed are carried over to its new shortest paths, rather than searched again.
+        """
+        return g.derived(("shortest_paths", weighted), lambda: ShortestPaths(g, weighted),
+                         lambda previous, edits: previous.updated(g, edits))
+
+    def updated(self, g: Graph, edits: List[Edit]) -> "ShortestPaths":
+        """
+        Args:
+            g: The graph these shortest paths were found on, after being edited
+            edits: The edits made to g since, in order
+
+        Returns:
+            Shortest paths of the edited graph, sharing the trees of this one which are unaffected by the edits.
+        """
+        paths = ShortestPaths(g, self.weighted)
+        if any(v not in paths._index for v in self._vertices):
+            return paths
+
+        for source, (distances, predecessors) in self._trees.items():
+            if not any(self._changes_tree(distances, predecessors, edit) for edit in edits):
+                paths._trees[paths._index[self._vertices[source]]] = paths._remap(self, distances, predecessors)
+        return paths
+
+    def _changes_tree(self, distances: np.ndarray, predecessors: np.ndarray, edit: Edit) -> bool:
+        """Whether an edit to a directed edge (u, v) could change a shortest path tree"""
+        u, v, added = edit
+        if u not in self._index or v not in self._index:
+            # Edges to or from new vertices can only change trees which reach them
+            return added and u in self._index and bool(np.isfinite(distances[self._index[u]]))
+
+        u, v = self._index[u], self._index[v]
+        if not added:
+            return predecessors[v] == u
+
+        # An added edge changes the tree if it gives v a shorter (or equally short, so possibly preferred) route
+        length = np.hypot(*np.subtract(self._vertices[u], self._vertices[v])) if self.weighted else 1
+        return distances[u] + length <= distances[v]
+
+    def _remap(self, other: "ShortestPaths", distances: np.ndarray,
+               predecessors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Converts a tree of other, whose vertices are all in this graph, to this graph's vertex numbering"""
+        to_self = np.array([self._index[v] for v in other._vertices], dtype=np.int64)
+
+        new_distances = np.full(len(self._vertices), np.inf)
+        new_distances[to_self] = distances
+        new_predecessors = np.full(len(self._vertices), -1, dtype=np.int64)
+        new_predecessors[to_self] = np.where(predecessors >= 0, to_self[predecessors], -1)
+        return new_distances, new_predecessors
+
+    def __getitem__(self, source: T) -> "Routes":
+        if source not in self._endpoint_set:
+            raise KeyError(source)
+        index = self._index[source]
+        if index not in self._trees:
+            self._trees[index] = self._search(index)
+        return Routes(self, source, self._trees[index][1])
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self._endpoints)
+
+    def __len__(self) -> int:
+        return len(self._endpoints)
+
+    def _search(self, source: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the distance to each vertex from source, and its predecessor in the shortest path tree from source (or
+        -1 if unreachable)
+        """
+        if self.weighted:
+            distances, predecessors = dijkstra(self._adjacency, indices=source, return_predecessors=True)
+            return distances, np.where(predecessors < 0, -1, predecessors)
+
+        # The search gives the distance to each vertex, and each vertex's predecessor is then the smallest vertex with a
+        # road into it, which is one step closer to the source
+        distances = dijkstra(self._adjacency, unweighted=True, indices=source)
+        rows, neighbours = self._incoming_rows, self._incoming.indices
+        on_tree = (distances[neighbours] == distances[rows] - 1) & np.isfinite(distances[rows])
+
+        rows, neighbours = rows[on_tree], neighbours[on_tree]
+        # Rows are in order, with neighbours sorted within each row, so the first entry of each row is its smallest
+        first = np.flatnonzero(np.diff(rows, prepend=-1))
+
+        predecessors = np.full(len(self._vertices), -1, dtype=np.int64)
+        predecessors[rows[first]] = neighbours[first]
+        return distances, predecessors
+
+
+class Routes(Mapping):
+    """Shortest routes from a single endpoint to every other reachable endpoint, built as they are looked up"""
+
+    def __init__(self, paths: ShortestPaths, source: T, predecessors: np.ndarray):
+        self._paths = paths
+        self._source = source
+        # Routes are walked one vertex at a time, which is faster over a list than an array
+        self._predecessors = predecessors.tolist()
+
+        index = paths._index
+        self._destinations = [v for v in paths._endpoints
+                              if v != source and self._predecessors[index[v]] >= 0]
+
+    def __getitem__(self, destination: T) -> List[T]:
+        index = self._paths._index
+        if destination == self._source or destination not in self._paths._endpoint_set or \
+                self._predecessors[index[destination]] < 0:
+            raise KeyError(destination)
+
+        vertices = self._paths._vertices
+        route = []
+        u = index[destination]
+        while u >= 0:
+            route.append(vertices[u])
+            u = self._predecessors[u]
+        route.reverse()
+        return route
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self._destinations)
+
+    def __len__(self) -> int:
+        return len(self._destinations)
@@ -0,0 +1,134 @@
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONWriter:
+    """
+    Writes JSON documents (such as roadnets and flows) to binary file handles in compact form, a piece at a time,
+    rather than building the whole encoded document in memory first.
+
+    The top stream_depth levels of a document's dictionaries and lists are written item by item, and everything below
+    them is encoded whole by the backend - either the standard library's json, or orjson, which is much faster. Objects
+    which appear repeatedly in a document, such as the vehicle template shared by every flow, are only encoded once.
+
+    orjson is opt-in, as it encodes some values differently to json (e.g. NaN as null) - and files, and the hashes the
+    artifact cache keys them by, should not depend on which packages happen to be installed.
+    """
+
+    def __init__(self, backend: Optional[str] = None, stream_depth: int = 2, buffer_size: int = 1 << 16):
+        """
+        Args:
+            backend: "json" (the default) or "orjson"
+            stream_depth: Number of levels of the document to write item by item
+            buffer_size: Number of bytes to buffer between writes to the file
+        """
+        if backend is None:
+            backend = "json"
+        if backend == "orjson" and orjson is None:
+            raise ImportError("The orjson backend requires orjson to be installed")
+        if backend not in ("json", "orjson"):
+            raise ValueError(f"Unknown JSON backend {backend}")
+
+        self.backend = backend
+        self.stream_depth = stream_depth
+        self.buffer_size = buffer_size
+        self._encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def encode(self, obj) -> bytes:
+        """Encodes obj whole, in compact form"""
+        if self.backend == "orjson":
+            return orjson.dumps(obj, default=_to_builtin, option=orjson.OPT_SERIALIZE_NUMPY)
+        return self._encoder.encode(obj).encode()
+
+    def chunks(self, document) -> Iterator[bytes]:
+        """Yields the compact encoding of document, in pieces"""
+        # Repeated objects are usually shared by neighbouring items, so only the most recent are remembered
+        yield from self._chunks(document, self.stream_depth, OrderedDict())
+
+    def _chunks(self, obj, depth: int, recent: OrderedDict) -> Iterator[bytes]:
+        if depth > 0 and isinstance(obj, dict) and obj:
+            separator = b"{"
+            for key, value in obj.items():
+                yield separator + self.encode(str(key)) + b":"
+                yield from self._chunks(value, depth - 1, recent)
+                separator = b","
+            yield b"}"
+        elif depth > 0 and isinstance(obj, (list, tuple)) and obj:
+            separator = b"["
+            for value in obj:
+                yield separator
+                yield from self._chunks(value, depth - 1, recent)
+                separator = b","
+            yield b"]"
+        elif isinstance(obj, (dict, list)):
+            # The object is kept alongside its encoding, so that its id can't be reused while it is remembered
+            if id(obj) in recent:
+                recent.move_to_end(id(obj))
+            else:
+                recent[id(obj)] = (obj, self.encode(obj))
+                if len(recent) > 16:
+                    recent.popitem(last=False)
+            yield recent[id(obj)][1]
+        else:
+            yield self.encode(obj)
+
+    def dump(self, document, f: BinaryIO) -> int:
+        """Writes document to the binary file handle f, returning the number of bytes written"""
+        written = 0
+        buffer = []
+        buffered = 0
+        for chunk in self.chunks(document):
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= self.buffer_size:
+                f.write(b"".join(buffer))
+                written += buffered
+                buffer, buffered = [], 0
+        f.write(b"".join(buffer))
+        return written + buffered
+
+
+def _to_builtin(obj):
+    """Converts the NumPy scalars orjson can't encode itself (but json can) to Python numbers"""
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+@contextmanager
+def atomic_write(path: str) -> Iterator[BinaryIO]:
+    """
+    Opens a temporary binary file next to path, which replaces path once the block exits without error - so that
+    other processes only ever see the complete file, or none at all.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_json(document, path: str, writer: Optional[JSONWriter] = None) -> None:
+    """Atomically writes document to path, in compact form"""
+    writer = JSONWriter() if writer is None else writer
+    with atomic_write(path) as f:
+        writer.dump(document, f)
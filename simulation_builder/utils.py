@@ -2,6 +2,7 @@ import json
 import os
 
 from CityFlow.tools.generator.generate_json_from_grid import gridToRoadnet
+from simulation_builder.serialization import atomic_write, write_json
 
 
 def generate_roadnet(rowNum: int, colNum: int, rowDistance: int = 300, columnDistance: int = 300,
@@ -87,7 +88,7 @@ def generate_roadnet(rowNum: int, colNum: int, rowDistance: int = 300, columnDis
 		"tlPlan": tlPlan
 	}
 
-	json.dump(gridToRoadnet(**grid), open(os.path.join(directory, "roadnets/", roadnetFile), "w"), indent=4)
+	write_json(gridToRoadnet(**grid), os.path.join(directory, "roadnets/", roadnetFile))
 
 	vehicle_template = {
 		"length": vehLen,
@@ -110,7 +111,7 @@ def generate_roadnet(rowNum: int, colNum: int, rowDistance: int = 300, columnDis
 			"startTime": 0,
 			"endTime": -1
 		})
-	json.dump(flow, open(os.path.join(directory, "flows/", flowFile), "w"), indent=4)
+	write_json(flow, os.path.join(directory, "flows/", flowFile))
 
 	with open("cityflow_config/config.json", "r") as f:
 		config_file = json.load(f)
@@ -118,5 +119,6 @@ def generate_roadnet(rowNum: int, colNum: int, rowDistance: int = 300, columnDis
 	config_file["roadnetFile"] = f"roadnets/{roadnetFile}"
 	config_file["flowFile"] = f"flows/{flowFile}"
 
-	with open("cityflow_config/config.json", "w") as f:
-		json.dump(config_file, f, indent=4)
+	# The config is kept readable, as it is edited by hand
+	with atomic_write("cityflow_config/config.json") as f:
+		f.write(json.dumps(config_file, indent=4).encode())